@@ -0,0 +1,68 @@
+"""
+Per-frame cost of the duplicate check in camera.py
+Compares the old list-based implementation to the NumPy one across cache sizes
+
+python benchmark_dhash.py --sizes 25 1000 10000 100000
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from camera import RecentHashes, calculate_hash_similarity, compute_dhash
+
+
+def legacy_dhash(frame, hash_size=8):
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    resized = cv2.resize(gray, (hash_size + 1, hash_size))
+    diff = resized[:, 1:] > resized[:, :-1]
+    return sum([2 ** i for (i, v) in enumerate(diff.flatten()) if v])
+
+
+def legacy_is_unique(recent, current_hash, threshold, cache_size):
+    for recent_hash in recent:
+        if calculate_hash_similarity(current_hash, recent_hash) <= threshold:
+            return False
+    recent.append(current_hash)
+    if len(recent) > cache_size:
+        recent.pop(0)
+    return True
+
+
+def per_call(fn, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[25, 1000, 10000, 100000])
+    parser.add_argument('--repeats', type=int, default=50)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, size=(1080, 1920, 3), dtype=np.uint8)
+
+    # Resizing before the grayscale conversion can flip a bit or two versus the legacy order
+    drift = calculate_hash_similarity(legacy_dhash(frame), compute_dhash(frame))
+    print(f"legacy vs numpy hash distance: {drift}")
+    print(f"hash 1920x1080: legacy {per_call(lambda: legacy_dhash(frame), args.repeats):.3f} ms, "
+          f"numpy {per_call(lambda: compute_dhash(frame), args.repeats):.3f} ms")
+
+    # Threshold 0 with random hashes: every frame is unique, so each check scans the full cache
+    for size in args.sizes:
+        hashes = [int(h) for h in rng.integers(0, 2 ** 63, size=size, dtype=np.int64)]
+        current = int(rng.integers(0, 2 ** 63))
+
+        recent = list(hashes)
+        legacy_ms = per_call(lambda: legacy_is_unique(recent, current, 0, size), max(1, args.repeats // 10))
+
+        ring = RecentHashes(size)
+        for h in hashes:
+            ring.add(h)
+        numpy_ms = per_call(lambda: ring.min_distance(current), args.repeats)
+
+        print(f"cache {size:>7}: legacy {legacy_ms:9.3f} ms/frame, numpy {numpy_ms:7.3f} ms/frame")
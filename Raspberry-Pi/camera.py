@@ -3,24 +3,48 @@ import time
 import requests
 from datetime import datetime
 import os
+import re
+import socket
 import logging
 import hashlib
 from pathlib import Path
 import base64
+import json
+import queue
+import threading
+import numpy as np
+from requests.adapters import HTTPAdapter
+
+# Outcome of an upload, per frame: accepted, worth retrying after a backoff, or refused for good
+SENT, RETRY, REJECTED = 'sent', 'retry', 'rejected'
+# Client errors that may succeed later; any other 4xx would refuse the same frame again
+RETRYABLE_STATUSES = (408, 429)
+
+def upload_outcome(status_code):
+    """SENT, RETRY or REJECTED for an HTTP status; 5xx and RETRYABLE_STATUSES are retried"""
+    if status_code in (200, 202):
+        return SENT
+    if status_code >= 500 or status_code in RETRYABLE_STATUSES:
+        return RETRY
+    return REJECTED
+
+# Number of set bits in each byte value, for popcounts without np.bitwise_count
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
 
 def compute_dhash(frame, hash_size=8):
     """
     Compute the difference hash  of an image
     """
-    # Convert to grayscale and resize
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    resized = cv2.resize(gray, (hash_size + 1, hash_size))
+    # Resize first so the grayscale conversion only touches the tiny image
+    resized = cv2.resize(frame, (hash_size + 1, hash_size))
+    if resized.ndim == 3:
+        resized = cv2.cvtColor(resized, cv2.COLOR_BGR2GRAY)
     
     # Compute differences between adjacent pixels
     diff = resized[:, 1:] > resized[:, :-1]
     
-    # Convert binary array to hash
-    return sum([2 ** i for (i, v) in enumerate(diff.flatten()) if v])
+    # Pack bits so bit i of the hash is diff.flatten()[i]
+    return int.from_bytes(np.packbits(diff.ravel(), bitorder='little').tobytes(), 'little')
 
 def calculate_hash_similarity(hash1, hash2):
     """
@@ -29,14 +53,71 @@ def calculate_hash_similarity(hash1, hash2):
     """
     return bin(hash1 ^ hash2).count('1')
 
+def hamming_distances(hashes, current_hash):
+    """
+    Hamming distance from current_hash to every hash in a uint64 array
+    """
+    xor = np.bitwise_xor(hashes, np.uint64(current_hash))
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(xor)
+    return _POPCOUNT_TABLE[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+class RecentHashes:
+    def __init__(self, size):
+        """
+        Fixed-size ring buffer of the most recent 64-bit hashes
+        """
+        self.size = size
+        self.hashes = np.zeros(size, dtype=np.uint64)
+        self.count = 0
+        self.position = 0
+
+    def min_distance(self, current_hash):
+        """
+        Smallest Hamming distance to any stored hash, or None if empty
+        """
+        filled = min(self.count, self.size)
+        if not filled:
+            return None
+        return int(hamming_distances(self.hashes[:filled], current_hash).min())
+
+    def add(self, current_hash):
+        self.hashes[self.position] = current_hash
+        self.position = (self.position + 1) % self.size
+        self.count += 1
+
+def default_device_id(camera_id):
+    """Name for this camera that is unique across devices: hostname plus camera index, in the server's id charset"""
+    name = re.sub(r'[^A-Za-z0-9_-]', '-', socket.gethostname()).strip('-_') or "camera"
+    return f"{name[:56]}-cam{camera_id}"
+
+
 class CameraUploader:
-    def __init__(self, api_endpoint, camera_id=0, save_local=False, local_path="./captures", cache_size=25, similarity_threshold=5):
+    def __init__(self, api_endpoint, camera_id=0, save_local=False, local_path="./captures", cache_size=25, similarity_threshold=5,
+                 spool_path="./spool", spool_max_files=5000, spool_batch_size=50, queue_size=8, max_backoff=60.0, timeout=10.0,
+                 upload_mode="json", raw_endpoint=None, batch_endpoint=None, batch_size=1, batch_max_age=60.0,
+                 device_id=None, household_id=None):
         """
         Initialize the camera and uploader
         api_endpoint: URL where images will be sent
         camera_id: Camera device ID (usually 0 for first USB camera)
         save_local: Whether to save images locally
         local_path: Directory to save images if save_local is True
+        spool_path: Directory where frames that could not be uploaded wait for the server;
+            frames the server refuses for good are moved to its "rejected" subdirectory
+        spool_max_files: Oldest spooled (and oldest rejected) frames are dropped past this many
+        spool_batch_size: Frames sent per spool drain pass, in a single /upload_batch request
+            (one request per frame against a server without that route)
+        queue_size: Capacity of the queues between the capture, encode and upload stages
+        max_backoff: Upper bound in seconds on the wait between retries while the server is unreachable
+        timeout: HTTP timeout in seconds
+        upload_mode: "json" posts base64 in JSON to api_endpoint, "raw" posts the JPEG bytes to raw_endpoint
+        raw_endpoint: URL of the binary upload route (defaults to /upload_image_raw next to api_endpoint)
+        batch_endpoint: URL of the batch upload route (defaults to /upload_batch next to api_endpoint)
+        batch_size: Accumulate this many frames before uploading them in one request (1 disables batching)
+        batch_max_age: Flush a partial batch once its oldest frame has waited this many seconds
+        device_id: Id this camera uploads under, unique across cameras (defaults to hostname + camera_id)
+        household_id: Household the camera belongs to; the server keeps and searches each household separately
         """
         logging.basicConfig(level=logging.INFO)
         self.logger = logging.getLogger(__name__)
@@ -50,17 +131,65 @@ class CameraUploader:
         self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 1080)
         
         self.api_endpoint = api_endpoint
+        self.device_id = device_id or default_device_id(camera_id)
+        self.household_id = household_id
+        # Sent with every upload so the server files frames under this household and camera
+        self.device_fields = {'camera_id': self.device_id}
+        if household_id:
+            self.device_fields['household_id'] = household_id
+        self.upload_mode = upload_mode
+        self.raw_endpoint = raw_endpoint or api_endpoint.rsplit('/', 1)[0] + "/upload_image_raw"
+        self.batch_endpoint = batch_endpoint or api_endpoint.rsplit('/', 1)[0] + "/upload_batch"
+        # Cleared once the server answers the batch route with 404 / 405
+        self.batch_route = True
+        self.batch_size = batch_size
+        self.batch_max_age = batch_max_age
         self.save_local = save_local
         self.local_path = Path(local_path)
 
-        self.recent_hashes = []
+        self.recent_hashes = RecentHashes(cache_size)
         self.cache_size = cache_size
         self.similarity_threshold = similarity_threshold
         
         if save_local:
             self.local_path.mkdir(exist_ok=True)
+
+        self.spool_path = Path(spool_path)
+        self.spool_path.mkdir(exist_ok=True)
+        self.rejected_path = self.spool_path / "rejected"
+        self.spool_max_files = spool_max_files
+        self.spool_batch_size = spool_batch_size
+
+        # Keep-alive connection reused for every upload
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.timeout = timeout
+
+        # Stages: capture -> encode_queue -> encode -> upload_queue -> upload
+        self.encode_queue = queue.Queue(maxsize=queue_size)
+        self.upload_queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+
+        # Exponential backoff while the server is unreachable
+        self.max_backoff = max_backoff
+        self.backoff = 0.0
+        self.retry_at = 0.0
     
     def capture_image(self):
+        """Capture and encode one frame; returns (img_base64, timestamp) or (None, None)"""
+        frame, timestamp = self.capture_frame()
+        if frame is None:
+            return None, None
+
+        jpeg_bytes = self.encode_frame(frame, timestamp)
+        if jpeg_bytes is None:
+            return None, None
+
+        return base64.b64encode(jpeg_bytes).decode('utf-8'), timestamp
+
+    def capture_frame(self):
+        """Read a frame and drop it if it is a near-duplicate; returns (frame, timestamp) or (None, None)"""
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         try:
             # Capture frame
@@ -74,88 +203,296 @@ class CameraUploader:
             if not self.is_image_unique(frame):
                 self.logger.info(f"Non-unique image: {timestamp}")
                 return None, None
+
+            return frame, timestamp
             
+        except Exception as e:
+            self.logger.error(f"Error capturing image: {str(e)}")
+            return None, None
+
+    def encode_frame(self, frame, timestamp):
+        """Downscale and JPEG-encode a frame for upload, saving the full-size image if save_local is set"""
+        try:
             # Downscale
             frameDownscaled = cv2.resize(frame, (1280, 720), interpolation=cv2.INTER_AREA)
-            # Convert frame to bytes
-            _, img_encoded = cv2.imencode('.jpg', frame)
-            img_bytes = img_encoded.tobytes()
-
             _, img_encoded_down = cv2.imencode('.jpg', frameDownscaled)
-            img_base64 = base64.b64encode(img_encoded_down.tobytes()).decode('utf-8')
             
-            # Save locally
+            # Save locally; the full-resolution JPEG is only encoded when it is kept
             if self.save_local:
+                _, img_encoded = cv2.imencode('.jpg', frame)
                 img_path = self.local_path / f"image_{timestamp}.jpg"
                 with open(img_path, 'wb') as f:
-                    f.write(img_bytes)
+                    f.write(img_encoded.tobytes())
                 
-            return img_base64, timestamp
+            return img_encoded_down.tobytes()
             
         except Exception as e:
-            self.logger.error(f"Error capturing image: {str(e)}")
-            return None, None
+            self.logger.error(f"Error encoding image: {str(e)}")
+            return None
     
     def is_image_unique(self, frame):
         current_hash = compute_dhash(frame)
         
-        # Compare with recent hashes
-        for recent_hash in self.recent_hashes:
-            difference = calculate_hash_similarity(current_hash, recent_hash)
-            self.logger.info(f"Threshold: {difference}")
-            if difference <= self.similarity_threshold:
-                return False
+        # Compare with all recent hashes at once
+        difference = self.recent_hashes.min_distance(current_hash)
+        self.logger.debug(f"Closest recent hash distance: {difference}")
+        if difference is not None and difference <= self.similarity_threshold:
+            return False
         
-        # Update recent hashes list
-        self.recent_hashes.append(current_hash)
-        if len(self.recent_hashes) > self.cache_size:
-            self.recent_hashes.pop(0)  # Remove oldest hash
+        # Update recent hashes, overwriting the oldest once full
+        self.recent_hashes.add(current_hash)
             
         return True
     
     def upload_image(self, img_base64, timestamp):
-        """Upload image to API endpoint"""
+        """Upload image to API endpoint; returns SENT, RETRY or REJECTED"""
         filename = f"image_{timestamp}.jpg"
         img_base64 = img_base64.replace('\n', '').replace('\r', '')
         try:
-            data = {'filename': filename, 'base64':img_base64, 'timestamp':timestamp}
+            data = {'filename': filename, 'base64':img_base64, 'timestamp':timestamp, **self.device_fields}
             
-            response = requests.post(
+            response = self.session.post(
                 self.api_endpoint,
-                json=data
+                json=data,
+                timeout=self.timeout
             )
             
-            if response.status_code == 200:
+            if response.status_code in (200, 202):
                 self.logger.info(f"Successfully uploaded image from {timestamp}")
-                return True
             else:
-                self.logger.error(f"Failed to upload image: {response.status_code}")
-                return False
+                self.logger.error(f"Failed to upload image: {response.status_code} {response.text[:200]}")
+            return upload_outcome(response.status_code)
         except Exception as e:
             self.logger.error(f"Error uploading image: {str(e)}")
-            return False
+            return RETRY
+
+    def spool_frame(self, jpeg_bytes, timestamp, spool_path=None):
+        """
+        Persist an unsent frame to disk so it survives restarts and network outages
+        spool_path: defaults to the spool; rejected_path keeps frames the server refused, for inspection
+        """
+        spool_path = spool_path or self.spool_path
+        try:
+            spool_path.mkdir(exist_ok=True)
+            (spool_path / f"image_{timestamp}.jpg").write_bytes(jpeg_bytes)
+            (spool_path / f"image_{timestamp}.json").write_text(json.dumps({'timestamp': timestamp}))
+        except Exception as e:
+            self.logger.error(f"Error spooling image: {str(e)}")
+            return
+
+        spooled = sorted(spool_path.glob("*.json"))
+        for meta_path in spooled[:max(0, len(spooled) - self.spool_max_files)]:
+            self.logger.warning(f"Spool full, dropping {meta_path.stem}")
+            self._unspool(meta_path)
+
+    def reject_frame(self, jpeg_bytes, timestamp):
+        """Set aside a frame the server refused for good, instead of retrying it forever"""
+        self.logger.error(f"Server rejected image from {timestamp}, moving it to {self.rejected_path}")
+        self.spool_frame(jpeg_bytes, timestamp, self.rejected_path)
+
+    def _unspool(self, meta_path):
+        meta_path.with_suffix('.jpg').unlink(missing_ok=True)
+        meta_path.unlink(missing_ok=True)
+
+    def drain_spool(self):
+        """
+        Upload up to spool_batch_size spooled frames, oldest first, in one batch request
+        Sent frames leave the spool, rejected ones move to rejected_path, the rest wait for the next pass
+        """
+        frames, meta_paths = [], []
+        for meta_path in sorted(self.spool_path.glob("*.json"))[:self.spool_batch_size]:
+            try:
+                timestamp = json.loads(meta_path.read_text())['timestamp']
+                jpeg_bytes = meta_path.with_suffix('.jpg').read_bytes()
+            except Exception as e:
+                self.logger.error(f"Dropping unreadable spool entry {meta_path.name}: {str(e)}")
+                self._unspool(meta_path)
+                continue
+            frames.append((jpeg_bytes, timestamp))
+            meta_paths.append(meta_path)
+
+        if not frames:
+            return
+        for meta_path, frame, outcome in zip(meta_paths, frames, self._send(frames)):
+            if outcome == REJECTED:
+                self.reject_frame(*frame)
+            if outcome != RETRY:
+                self._unspool(meta_path)
+
+    def _send(self, frames):
+        """
+        Upload frames (one request for a single frame or a whole batch) and update the backoff state
+        A batch the server refuses as a whole (too large, or no batch route) is retried frame by frame,
+        so only the frames it actually refuses are rejected
+        Returns SENT, RETRY or REJECTED for each frame
+        """
+        outcomes = None
+        if len(frames) > 1 and self.batch_route:
+            outcome = self.upload_batch(frames)
+            if outcome != REJECTED:
+                outcomes = [outcome] * len(frames)
+
+        if outcomes is None:
+            outcomes = []
+            for frame in frames:
+                # Once the server needs a backoff, the remaining frames wait for it too
+                outcomes.append(RETRY if RETRY in outcomes else self._send_one(*frame))
+
+        if RETRY not in outcomes:
+            self.backoff = 0.0
+            self.retry_at = 0.0
+            return outcomes
+
+        self.backoff = min(self.max_backoff, self.backoff * 2 if self.backoff else 1.0)
+        self.retry_at = time.monotonic() + self.backoff
+        self.logger.warning(f"Upload failed, retrying in {self.backoff:.0f}s")
+        return outcomes
+
+    def _send_one(self, jpeg_bytes, timestamp):
+        if self.upload_mode == "raw":
+            return self.upload_image_raw(jpeg_bytes, timestamp)
+        return self.upload_image(base64.b64encode(jpeg_bytes).decode('utf-8'), timestamp)
+
+    def upload_batch(self, frames):
+        """Upload several (jpeg_bytes, timestamp) frames as one multipart request; returns SENT, RETRY or REJECTED"""
+        filenames = [f"image_{timestamp}.jpg" for _, timestamp in frames]
+        try:
+            response = self.session.post(
+                self.batch_endpoint,
+                files=[('images', (filename, jpeg_bytes, 'image/jpeg')) for filename, (jpeg_bytes, _) in zip(filenames, frames)],
+                data={'filename': filenames, 'timestamp': [timestamp for _, timestamp in frames], **self.device_fields},
+                timeout=self.timeout
+            )
+
+            if response.status_code in (404, 405):
+                self.logger.warning(f"No batch route at {self.batch_endpoint}, uploading frames one at a time")
+                self.batch_route = False
+            elif response.status_code in (200, 202):
+                self.logger.info(f"Successfully uploaded batch of {len(frames)} images")
+            else:
+                self.logger.error(f"Failed to upload batch: {response.status_code} {response.text[:200]}")
+            return upload_outcome(response.status_code)
+        except Exception as e:
+            self.logger.error(f"Error uploading batch: {str(e)}")
+            return RETRY
+
+    def _encode_loop(self):
+        while not self.stop_event.is_set():
+            try:
+                frame, timestamp = self.encode_queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+
+            jpeg_bytes = self.encode_frame(frame, timestamp)
+            if jpeg_bytes is None:
+                continue
+
+            try:
+                self.upload_queue.put_nowait((jpeg_bytes, timestamp))
+            except queue.Full:
+                # Uploads are falling behind; park the frame on disk
+                self.spool_frame(jpeg_bytes, timestamp)
+
+    def _upload_loop(self):
+        pending = []
+        first_at = None
+        while not self.stop_event.is_set():
+            try:
+                pending.append(self.upload_queue.get(timeout=1.0))
+                first_at = first_at or time.monotonic()
+            except queue.Empty:
+                if not pending:
+                    # Idle: catch up on spooled frames once the backoff has elapsed
+                    if time.monotonic() >= self.retry_at:
+                        self.drain_spool()
+                    continue
+
+            # Keep accumulating until the batch is full or its oldest frame is too old
+            if len(pending) < self.batch_size and time.monotonic() - first_at < self.batch_max_age:
+                continue
+
+            frames, pending, first_at = pending, [], None
+            if time.monotonic() < self.retry_at:
+                outcomes = [RETRY] * len(frames)
+            else:
+                outcomes = self._send(frames)
+            for frame, outcome in zip(frames, outcomes):
+                if outcome == RETRY:
+                    self.spool_frame(*frame)
+                elif outcome == REJECTED:
+                    self.reject_frame(*frame)
+            if RETRY not in outcomes:
+                self.drain_spool()
+
+        for jpeg_bytes, timestamp in pending:
+            self.spool_frame(jpeg_bytes, timestamp)
+
+    def upload_image_raw(self, jpeg_bytes, timestamp):
+        """Upload JPEG bytes as the request body, with metadata in headers; returns SENT, RETRY or REJECTED"""
+        filename = f"image_{timestamp}.jpg"
+        try:
+            response = self.session.post(
+                self.raw_endpoint,
+                data=jpeg_bytes,
+                headers={
+                    'Content-Type': 'image/jpeg',
+                    'X-Filename': filename,
+                    'X-Timestamp': timestamp,
+                    'X-Camera-ID': self.device_id,
+                    **({'X-Household-ID': self.household_id} if self.household_id else {})
+                },
+                timeout=self.timeout
+            )
+
+            if response.status_code in (200, 202):
+                self.logger.info(f"Successfully uploaded image from {timestamp}")
+            else:
+                self.logger.error(f"Failed to upload image: {response.status_code} {response.text[:200]}")
+            return upload_outcome(response.status_code)
+        except Exception as e:
+            self.logger.error(f"Error uploading image: {str(e)}")
+            return RETRY
 
     def run(self, interval=10.0):
         """
-        Main loop to capture and upload images
+        Main loop to capture images; encoding and uploading run on their own threads
+        so capture cadence does not depend on network latency
         interval: Time between captures in seconds
         """
+        workers = [
+            threading.Thread(target=self._encode_loop, name="encode", daemon=True),
+            threading.Thread(target=self._upload_loop, name="upload", daemon=True)
+        ]
+        for worker in workers:
+            worker.start()
+
         try:
             self.logger.info("Starting capture and upload loop...")
+            next_capture = time.monotonic()
             while True:
-                start_time = time.time()
-                
-                # Capture and upload image
-                img_base64, timestamp = self.capture_image()
-                if img_base64:
-                    self.upload_image(img_base64, timestamp)
+                frame, timestamp = self.capture_frame()
+                if frame is not None:
+                    try:
+                        self.encode_queue.put_nowait((frame, timestamp))
+                    except queue.Full:
+                        self.logger.warning(f"Encoder behind, dropping frame {timestamp}")
                 
-                # Wait for remainder of interval
-                elapsed_time = time.time() - start_time
-                sleep_time = max(0, interval - elapsed_time)
-                time.sleep(sleep_time)
+                # Wait until the next slot on a fixed schedule, skipping slots we overran
+                next_capture = max(next_capture + interval, time.monotonic())
+                time.sleep(max(0, next_capture - time.monotonic()))
         except KeyboardInterrupt:
             self.logger.info("Stopping capture and upload loop...")
+        finally:
+            self.stop_event.set()
+            for worker in workers:
+                worker.join()
+
+            # Keep anything still queued for the next run
+            while not self.upload_queue.empty():
+                jpeg_bytes, timestamp = self.upload_queue.get_nowait()
+                self.spool_frame(jpeg_bytes, timestamp)
+
+            self.session.close()
             self.camera.release()
 
 if __name__ == "__main__":
@@ -165,7 +502,9 @@ if __name__ == "__main__":
         camera_id=0,  # Usually 0 for first USB camera
         save_local=True,  
         local_path="./captures",
-        similarity_threshold=25
+        similarity_threshold=25,
+        upload_mode="raw",
+        household_id=None  # Set when several homes share one server
     )
 
     uploader.run()
\ No newline at end of file
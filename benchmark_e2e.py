@@ -0,0 +1,450 @@
+"""
+End-to-end benchmark: server.py against fake_openai_server.py, each in its own process
+Uploads the sample captures through /upload_image, waits for ingest to finish, then asks /response
+questions (plain and streamed), all at the given client concurrency
+Reports ingest throughput, p50/p95/p99 latency per endpoint and per server-side stage, and server RSS growth
+
+python benchmark_e2e.py --uploads 200 --queries 100 --concurrency 8 --latency 0.3 --output results.json
+python benchmark_e2e.py --uploads 200 --queries 100 --concurrency 8 --latency 0.3 --compare results.json
+python benchmark_e2e.py --compare before.json after.json
+
+Repeated questions are answered from the server's answer cache after the first ask
+(the streamed pass reuses the plain pass's questions); --unique-queries measures the uncached path
+Dedupe is off by default because the same few sample images are uploaded over and over;
+--env passes any other server setting, e.g. --env VECTOR_STORE=numpy --env INGEST_WORKERS=8
+"""
+import argparse
+import base64
+import datetime
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import requests
+
+SAMPLES_DIR = Path('Raspberry-Pi/captures')
+
+QUESTIONS = [
+    "where did I leave my keys",
+    "did I take my medicine",
+    "what did I eat",
+    "what was I cooking",
+    "what is in the freezer",
+    "did I do the dishes",
+]
+
+# Changes smaller than this (as a fraction) are not flagged by --compare
+REGRESSION_THRESHOLD = 0.10
+
+_local = threading.local()
+
+
+def session():
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def rss_mb(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def latency_stats(seconds):
+    if not seconds:
+        return {'count': 0}
+    ms = np.asarray(seconds) * 1000
+    return {
+        'count': len(ms),
+        'mean_ms': round(float(ms.mean()), 2),
+        'p50_ms': round(float(np.percentile(ms, 50)), 2),
+        'p95_ms': round(float(np.percentile(ms, 95)), 2),
+        'p99_ms': round(float(np.percentile(ms, 99)), 2),
+        'max_ms': round(float(ms.max()), 2)
+    }
+
+
+def parse_server_timing(header):
+    """{stage: seconds} from a Server-Timing header; entries without a duration are skipped"""
+    timings = {}
+    for entry in (header or '').split(','):
+        name, *params = [p.strip() for p in entry.split(';')]
+        for param in params:
+            if param.startswith('dur='):
+                timings[name] = float(param[4:]) / 1000
+    return timings
+
+
+class MemorySampler(threading.Thread):
+    """Polls a process's RSS in the background to catch the peak between phases"""
+
+    def __init__(self, pid, interval=0.1):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0.0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.peak = max(self.peak, rss_mb(self.pid))
+            except (FileNotFoundError, ProcessLookupError):
+                return
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class Servers:
+    """Starts the fake model server and server.py on free ports in a scratch directory"""
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = Path(tempfile.mkdtemp(prefix='retrospecs_bench_'))
+        self.processes = []
+
+    def __enter__(self):
+        args = self.args
+        model_port, self.port = free_port(), free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+
+        self._spawn('fake_openai', [
+            sys.executable, 'fake_openai_server.py', '--port', str(model_port),
+            '--latency', str(args.latency), '--failure-rate', str(args.failure_rate),
+            '--token-latency', str(args.token_latency), '--seed', '0'
+        ], os.environ.copy())
+
+        # The seed photos point at the sample captures, so /response needs them in its capture dir
+        captures = self.workdir / 'captures'
+        shutil.copytree(SAMPLES_DIR, captures, ignore=shutil.ignore_patterns('variants'))
+
+        env = dict(os.environ)
+        env.update({
+            'FAKE_OPENAI': '0',
+            'OPENAI_BASE_URL': f"http://127.0.0.1:{model_port}/v1",
+            'OPENAI_API_KEY': 'fake',
+            'PORT': str(self.port),
+            'CAPTURE_DIR': str(captures),
+            'CHROMA_PERSIST_DIR': str(self.workdir / 'store'),
+            'DEDUPE_THRESHOLD': '5' if args.dedupe else '-1',
+            'INGEST_QUEUE_SIZE': str(max(64, args.concurrency * 4))
+        })
+        for item in args.env:
+            key, _, value = item.partition('=')
+            env[key] = value
+        self.server = self._spawn('server', [sys.executable, 'server.py'], env)
+
+        self._wait_ready()
+        return self
+
+    def __exit__(self, *exc):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if not self.args.keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _spawn(self, name, command, env):
+        log = open(self.workdir / f"{name}.log", 'wb')
+        process = subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+        self.processes.append(process)
+        return process
+
+    def _wait_ready(self, timeout=120):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.server.poll() is not None:
+                log = (self.workdir / 'server.log').read_text(errors='replace')
+                raise RuntimeError(f"server.py exited during startup:\n{log[-2000:]}")
+            try:
+                if requests.get(f"{self.base_url}/readyz", timeout=1).ok:
+                    return
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError("server.py did not become ready")
+
+
+def run_ingest(base_url, uploads, concurrency):
+    """Upload `uploads` captures, then poll their jobs until all have finished"""
+    samples = sorted(SAMPLES_DIR.glob('*.jpg'))
+    payloads = [base64.b64encode(p.read_bytes()).decode('utf-8') for p in samples]
+    start_ts = datetime.datetime(2024, 11, 18, 8, 0, 0)
+
+    latencies, rejected = [], [0]
+    lock = threading.Lock()
+
+    def upload(i):
+        body = {
+            'filename': f"bench_{i:05d}_{samples[i % len(samples)].name}",
+            'base64': payloads[i % len(payloads)],
+            'timestamp': (start_ts + datetime.timedelta(seconds=i)).strftime('%Y%m%d_%H%M%S')
+        }
+        while True:
+            t0 = time.perf_counter()
+            response = session().post(f"{base_url}/upload_image", json=body)
+            elapsed = time.perf_counter() - t0
+            with lock:
+                latencies.append(elapsed)
+            if response.status_code != 503:
+                response.raise_for_status()
+                return response.json()['job_id']
+            # Queue full: back off briefly rather than the full Retry-After, to keep the queue saturated
+            with lock:
+                rejected[0] += 1
+            time.sleep(min(float(response.headers.get('Retry-After', 1)), 0.2))
+
+    submitted = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        job_ids = list(pool.map(upload, range(uploads)))
+    accept_s = time.time() - submitted
+
+    jobs, pending = {}, set(job_ids)
+    while pending:
+        for job_id in list(pending):
+            job = session().get(f"{base_url}/jobs/{job_id}").json()
+            if job['status'] in ('done', 'failed'):
+                jobs[job_id] = job
+                pending.discard(job_id)
+        if pending:
+            time.sleep(0.1)
+
+    done = [j for j in jobs.values() if j['status'] == 'done']
+    elapsed = max(j['finished'] for j in jobs.values()) - submitted
+
+    stages = {'queue_wait': [j['started'] - j['created'] for j in jobs.values()],
+              'job': [j['finished'] - j['created'] for j in jobs.values()]}
+    for job in done:
+        for stage, seconds in (job['result'] or {}).get('timings', {}).items():
+            stages.setdefault(stage, []).append(seconds)
+
+    summary = {
+        'uploads': uploads,
+        'rejected_503': rejected[0],
+        'done': len(done),
+        'failed': len(jobs) - len(done),
+        'duplicates': sum(1 for j in done if j['result'].get('duplicate_of')),
+        'attempts': sum(j['attempts'] for j in jobs.values()),
+        'accept_s': round(accept_s, 3),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_per_s': round(len(done) / elapsed, 2) if elapsed > 0 else None
+    }
+    return summary, latencies, stages
+
+
+def run_queries(base_url, queries, concurrency, unique):
+    """Plain /response requests; returns latencies, Server-Timing stages, answer cache hits and errors"""
+    latencies, stages, hits, errors = [], {}, [0], [0]
+    lock = threading.Lock()
+
+    def ask(i):
+        question = QUESTIONS[i % len(QUESTIONS)] + (f" {i}" if unique else "")
+        t0 = time.perf_counter()
+        response = session().post(f"{base_url}/response", json={'query': question})
+        elapsed = time.perf_counter() - t0
+        with lock:
+            if response.status_code != 200:
+                errors[0] += 1
+                return
+            latencies.append(elapsed)
+            header = response.headers.get('Server-Timing', '')
+            if header.startswith('cache'):
+                hits[0] += 1
+            for stage, seconds in parse_server_timing(header).items():
+                stages.setdefault(stage, []).append(seconds)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(ask, range(queries)))
+    return latencies, stages, hits[0], errors[0]
+
+
+def run_stream_queries(base_url, queries, concurrency, unique):
+    """Streamed /response requests; returns total, first "match" event and first "token" event latencies"""
+    total, first_match, first_token, errors = [], [], [], [0]
+    lock = threading.Lock()
+
+    def ask(i):
+        question = QUESTIONS[i % len(QUESTIONS)] + (f" stream {i}" if unique else "")
+        t0 = time.perf_counter()
+        match_at = token_at = None
+        with session().post(f"{base_url}/response", json={'query': question, 'stream': True}, stream=True) as response:
+            for line in response.iter_lines(decode_unicode=True):
+                if line == 'event: match' and match_at is None:
+                    match_at = time.perf_counter() - t0
+                elif line == 'event: token' and token_at is None:
+                    token_at = time.perf_counter() - t0
+                elif line == 'event: error':
+                    with lock:
+                        errors[0] += 1
+                    return
+        elapsed = time.perf_counter() - t0
+        with lock:
+            total.append(elapsed)
+            if match_at is not None:
+                first_match.append(match_at)
+            if token_at is not None:
+                first_token.append(token_at)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(ask, range(queries)))
+    return total, first_match, first_token, errors[0]
+
+
+def run(args):
+    with Servers(args) as servers:
+        pid, base_url = servers.server.pid, servers.base_url
+        sampler = MemorySampler(pid)
+        sampler.start()
+        memory = {'rss_start_mb': rss_mb(pid)}
+
+        ingest, upload_latencies, ingest_stages = run_ingest(base_url, args.uploads, args.concurrency)
+        memory['rss_after_ingest_mb'] = rss_mb(pid)
+
+        query_latencies, query_stages, cache_hits, query_errors = run_queries(
+            base_url, args.queries, args.concurrency, args.unique_queries)
+        stream_total, stream_match, stream_token, stream_errors = run_stream_queries(
+            base_url, args.stream_queries, args.concurrency, args.unique_queries)
+        memory['rss_end_mb'] = rss_mb(pid)
+
+        sampler.stop()
+        memory['rss_peak_mb'] = max(sampler.peak, memory['rss_end_mb'])
+        memory['growth_mb'] = memory['rss_end_mb'] - memory['rss_start_mb']
+        memory = {k: round(v, 1) for k, v in memory.items()}
+
+    return {
+        'config': {
+            'uploads': args.uploads,
+            'queries': args.queries,
+            'stream_queries': args.stream_queries,
+            'concurrency': args.concurrency,
+            'latency': args.latency,
+            'failure_rate': args.failure_rate,
+            'token_latency': args.token_latency,
+            'dedupe': args.dedupe,
+            'unique_queries': args.unique_queries,
+            'env': args.env,
+            'date': datetime.datetime.now().isoformat(timespec='seconds')
+        },
+        'ingest': ingest,
+        'queries': {
+            'answer_cache_hits': cache_hits,
+            'errors': query_errors,
+            'stream_errors': stream_errors
+        },
+        'endpoints': {
+            'upload_image': latency_stats(upload_latencies),
+            'response': latency_stats(query_latencies),
+            'response_stream': latency_stats(stream_total),
+            'response_stream_first_match': latency_stats(stream_match),
+            'response_stream_first_token': latency_stats(stream_token)
+        },
+        'stages': {
+            **{f"ingest.{stage}": latency_stats(v) for stage, v in ingest_stages.items()},
+            **{f"response.{stage}": latency_stats(v) for stage, v in query_stages.items()}
+        },
+        'memory': memory
+    }
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if key == 'config':
+            continue
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(baseline, current, threshold=REGRESSION_THRESHOLD):
+    """Print every metric side by side; returns the names of metrics that got worse by more than threshold"""
+    old, new = flatten(baseline), flatten(current)
+    regressions = []
+    print(f"{'metric':<52} {'baseline':>12} {'current':>12} {'change':>9}")
+    for name in sorted(set(old) | set(new)):
+        a, b = old.get(name), new.get(name)
+        if a is None or b is None:
+            print(f"{name:<52} {a if a is not None else '-':>12} {b if b is not None else '-':>12}")
+            continue
+        change = (b - a) / a if a else 0.0
+        # Throughput is the only metric where bigger is better; counts are informational
+        if name.endswith('throughput_per_s'):
+            worse = change < -threshold
+        elif name.endswith(('_ms', '_mb', '_s')) and not name.startswith('memory.rss_start'):
+            worse = change > threshold
+        else:
+            worse = False
+        if worse:
+            regressions.append(name)
+        print(f"{name:<52} {a:>12} {b:>12} {change:>+8.1%}{'  <-- worse' if worse else ''}")
+    return regressions
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uploads', type=int, default=100)
+    parser.add_argument('--queries', type=int, default=100, help="plain /response requests")
+    parser.add_argument('--stream-queries', type=int, default=None, help="streamed /response requests (default: --queries)")
+    parser.add_argument('--concurrency', type=int, default=8, help="client threads")
+    parser.add_argument('--latency', type=float, default=0.3, help="fake model latency per call (s)")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="fraction of fake model calls that fail")
+    parser.add_argument('--token-latency', type=float, default=0.01, help="fake delay between streamed tokens (s)")
+    parser.add_argument('--dedupe', action='store_true', help="keep near-duplicate detection on")
+    parser.add_argument('--unique-queries', action='store_true', help="make every question distinct to defeat the caches")
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help="extra server.py setting")
+    parser.add_argument('--keep', action='store_true', help="keep the scratch directory with the server logs")
+    parser.add_argument('--output', help="write results JSON here")
+    parser.add_argument('--compare', nargs='+', metavar='RESULTS',
+                        help="baseline JSON to compare this run against, or two JSON files to compare without running")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args()
+    if args.stream_queries is None:
+        args.stream_queries = args.queries
+
+    if args.compare and len(args.compare) == 2:
+        worse = compare(load_results(args.compare[0]), load_results(args.compare[1]), args.threshold)
+        sys.exit(1 if worse else 0)
+
+    results = run(args)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        print()
+        worse = compare(load_results(args.compare[0]), results, args.threshold)
+        sys.exit(1 if worse else 0)
@@ -0,0 +1,76 @@
+"""
+Offline ingest throughput check for /upload_image
+Runs the Flask app in-process against the FakeOpenAI client and reports jobs/sec per worker count
+Each run gets a fresh store and capture directory in a temp directory, removed afterwards
+The samples are uploaded over and over, so server-side dedupe is off unless --dedupe is given;
+otherwise most uploads would skip the model and measure the duplicate shortcut instead
+
+python benchmark_ingest.py --images 200 --latency 0.2 --workers 1 4 8
+"""
+import argparse
+import base64
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+SAMPLES_DIR = Path('Raspberry-Pi/captures')
+
+
+def run(images, workers, latency, dedupe=False):
+    workdir = Path(tempfile.mkdtemp(prefix='retrospecs_ingest_'))
+    os.environ['CAPTURE_DIR'] = str(workdir / 'captures')
+    os.environ['CHROMA_PERSIST_DIR'] = str(workdir / 'store')
+    os.environ['FAKE_OPENAI'] = '1'
+    os.environ['DEDUPE_THRESHOLD'] = '5' if dedupe else '-1'
+    os.environ['FAKE_OPENAI_LATENCY'] = str(latency)
+    os.environ['INGEST_WORKERS'] = str(workers)
+    os.environ['INGEST_QUEUE_SIZE'] = str(images)
+
+    # Fresh import so the worker pool picks up this run's settings
+    sys.modules.pop('server', None)
+    import server
+
+    samples = sorted(SAMPLES_DIR.glob('*.jpg'))
+    payloads = [base64.b64encode(p.read_bytes()).decode('utf-8') for p in samples]
+
+    http = server.create_app(background=False).test_client()
+    start_ts = datetime.datetime(2024, 11, 18, 8, 0, 0)
+    start = time.time()
+    job_ids = []
+    for i in range(images):
+        response = http.post('/upload_image', json={
+            'filename': samples[i % len(samples)].name,
+            'base64': payloads[i % len(payloads)],
+            # Camera-style timestamps, distinct per upload so none is skipped as already stored
+            'timestamp': (start_ts + datetime.timedelta(seconds=i)).strftime('%Y%m%d_%H%M%S')
+        })
+        job_ids.append(response.get_json()['job_id'])
+    accepted = time.time() - start
+
+    server.ingest_queue.join()
+    elapsed = time.time() - start
+    statuses = [server.ingest_queue.status(j) for j in job_ids]
+    failed = sum(1 for s in statuses if s['status'] != 'done')
+    duplicates = sum(1 for s in statuses if 'duplicate_of' in (s.get('result') or {}))
+    server.ingest_queue.stop()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"workers={workers:<3} images={images} accept={accepted:.2f}s "
+          f"total={elapsed:.2f}s throughput={images / elapsed:.1f} img/s failed={failed} duplicates={duplicates}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.2, help="fake model latency per call (s)")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--dedupe', action='store_true', help="keep near-duplicate detection on")
+    args = parser.parse_args()
+
+    for w in args.workers:
+        run(args.images, w, args.latency, args.dedupe)
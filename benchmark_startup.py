@@ -0,0 +1,127 @@
+"""
+Startup-time benchmark: starts server.py as a fresh process several times and measures, from spawn,
+when it first answers /healthz (listening) and /readyz (store open, serving traffic), along with the
+phases the server reports itself in /readyz (import: module load, store: store opened, ready)
+Also times importing server.py and its heavy dependencies, each in a fresh interpreter
+
+python benchmark_startup.py --runs 5 --output startup.json
+python benchmark_startup.py --runs 5 --env VECTOR_STORE=numpy --compare startup.json
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import requests
+
+from benchmark_e2e import REGRESSION_THRESHOLD, compare, free_port, latency_stats, load_results
+
+# Timed one at a time, in a fresh interpreter each
+IMPORTS = ['flask', 'numpy', 'chromadb', 'openai', 'vectorDB', 'server']
+
+
+def start_once(env, timeout):
+    """Seconds from spawn to the first 200 of /healthz and of /readyz, and the server's own startup phases"""
+    workdir = Path(tempfile.mkdtemp(prefix='retrospecs_startup_'))
+    port = free_port()
+    env = dict(env, PORT=str(port), CAPTURE_DIR=str(workdir / 'captures'), CHROMA_PERSIST_DIR=str(workdir / 'store'))
+    base_url = f"http://127.0.0.1:{port}"
+    log = open(workdir / 'server.log', 'wb')
+
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, 'server.py'], env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        listening = ready = None
+        deadline = start + timeout
+        while ready is None:
+            if time.perf_counter() > deadline:
+                raise RuntimeError("server.py did not become ready")
+            if process.poll() is not None:
+                raise RuntimeError(f"server.py exited during startup:\n{(workdir / 'server.log').read_text()[-2000:]}")
+            try:
+                if listening is None and requests.get(f"{base_url}/healthz", timeout=1).ok:
+                    listening = time.perf_counter() - start
+                response = requests.get(f"{base_url}/readyz", timeout=1)
+                if response.ok:
+                    ready = time.perf_counter() - start
+                    phases = response.json()['startup']
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.01)
+        return listening, ready, phases
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+        log.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def import_seconds(module, env):
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    output = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def run(args):
+    env = dict(os.environ, FAKE_OPENAI='1')
+    for item in args.env:
+        key, _, value = item.partition('=')
+        env[key] = value
+
+    listening, ready, phases = [], [], {}
+    for i in range(args.runs):
+        l, r, p = start_once(env, args.timeout)
+        listening.append(l)
+        ready.append(r)
+        for phase, seconds in p.items():
+            phases.setdefault(phase, []).append(seconds)
+        print(f"run {i + 1}: listening {l * 1000:.0f} ms, ready {r * 1000:.0f} ms, server phases {p}", file=sys.stderr)
+
+    imports = {}
+    for module in IMPORTS:
+        samples = [import_seconds(module, env) for _ in range(args.import_runs)]
+        imports[module] = latency_stats(samples)
+
+    return {
+        'config': {'runs': args.runs, 'env': args.env},
+        'startup': {
+            'listening': latency_stats(listening),
+            'ready': latency_stats(ready),
+            # Measured inside the server, from server.py starting to load
+            'server': {phase: latency_stats(seconds) for phase, seconds in phases.items()}
+        },
+        'imports': imports
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5, help="server starts")
+    parser.add_argument('--import-runs', type=int, default=3, help="fresh-interpreter imports per module")
+    parser.add_argument('--timeout', type=float, default=60.0, help="seconds to wait for /readyz")
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help="extra server setting")
+    parser.add_argument('--output', help="write the results JSON here")
+    parser.add_argument('--compare', nargs='+', metavar='RESULTS',
+                        help="baseline JSON to compare this run against, or two JSON files to compare without running")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) == 2:
+        worse = compare(load_results(args.compare[0]), load_results(args.compare[1]), args.threshold)
+        sys.exit(1 if worse else 0)
+
+    results = run(args)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        print()
+        worse = compare(load_results(args.compare[0]), results, args.threshold)
+        sys.exit(1 if worse else 0)
@@ -0,0 +1,132 @@
+"""
+Chroma vs the NumPy memory-mapped store: build time, load (reopen) time, memory and query latency
+
+python benchmark_vector_store.py --sizes 10000 100000 1000000 --engines chroma numpy numpy-float16
+Building and measuring run in separate fresh processes, so load time is a true warm restart
+and RSS is not polluted by the build or by earlier runs
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+INSERT_BATCH = 5000
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+
+
+def dir_mb(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names) / 2 ** 20
+
+
+def open_collection(engine, path):
+    if engine == 'chroma':
+        import chromadb
+        return chromadb.PersistentClient(path=path).get_or_create_collection("bench")
+
+    from numpy_store import NumpyClient
+    return NumpyClient(path=path, dtype='float16' if engine == 'numpy-float16' else 'int8').get_or_create_collection("bench")
+
+
+def vectors(rng, n, dim):
+    v = rng.standard_normal((n, dim), dtype=np.float32)
+    return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+
+def build(engine, size, dim, path):
+    rng = np.random.default_rng(0)
+    collection = open_collection(engine, path)
+    start = time.perf_counter()
+    for offset in range(0, size, INSERT_BATCH):
+        n = min(INSERT_BATCH, size - offset)
+        collection.add(
+            ids=[f"photo_{i}" for i in range(offset, offset + n)],
+            embeddings=vectors(rng, n, dim),
+            documents=[f"description {i}" for i in range(offset, offset + n)],
+            metadatas=[{"timestamp": str(i), "ts": float(i), "filename": f"image_{i}.jpg"} for i in range(offset, offset + n)]
+        )
+    return {'build_s': round(time.perf_counter() - start, 2), 'disk_mb': round(dir_mb(path), 1)}
+
+
+def measure(engine, size, dim, path, queries):
+    """Runs in a fresh process: warm-restart load time, resident memory and query latency"""
+    base_rss = rss_mb()
+    start = time.perf_counter()
+    collection = open_collection(engine, path)
+    collection.count()
+    load_s = time.perf_counter() - start
+
+    qs = vectors(np.random.default_rng(1), queries, dim)
+    # Last 10% of the timeline, like a "today" query over weeks of frames
+    window = {"$and": [{"ts": {"$gte": size * 0.9}}, {"ts": {"$lte": float(size)}}]}
+    timings = {'query_ms': [], 'query_window_ms': []}
+    for q in qs:
+        start = time.perf_counter()
+        collection.query(query_embeddings=[q.tolist()], n_results=3)
+        timings['query_ms'].append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        collection.query(query_embeddings=[q.tolist()], n_results=3, where=window)
+        timings['query_window_ms'].append((time.perf_counter() - start) * 1000)
+
+    return {
+        'load_s': round(load_s, 3),
+        'rss_mb': round(rss_mb(), 1),
+        'rss_store_mb': round(rss_mb() - base_rss, 1),
+        **{f"{name}_p50": round(float(np.percentile(t, 50)), 3) for name, t in timings.items()},
+        **{f"{name}_p95": round(float(np.percentile(t, 95)), 3) for name, t in timings.items()},
+    }
+
+
+def run_phase(phase, engine, size, args, path):
+    out = subprocess.run(
+        [sys.executable, __file__, '--phase', phase, engine, str(size), path,
+         '--dim', str(args.dim), '--queries', str(args.queries)],
+        capture_output=True, text=True, check=True
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--engines', nargs='+', default=['chroma', 'numpy', 'numpy-float16'])
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--output', help="write results as JSON")
+    parser.add_argument('--phase', nargs=4, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.phase:
+        phase, engine, size, path = args.phase
+        if phase == 'build':
+            print(json.dumps(build(engine, int(size), args.dim, path)))
+        else:
+            print(json.dumps(measure(engine, int(size), args.dim, path, args.queries)))
+        sys.exit(0)
+
+    results = []
+    for size in args.sizes:
+        for engine in args.engines:
+            path = tempfile.mkdtemp(prefix=f"bench_{engine}_")
+            try:
+                result = {'engine': engine, 'size': size, 'dim': args.dim}
+                result.update(run_phase('build', engine, size, args, path))
+                result.update(run_phase('measure', engine, size, args, path))
+            finally:
+                shutil.rmtree(path, ignore_errors=True)
+            results.append(result)
+            print(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
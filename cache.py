@@ -0,0 +1,86 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+def normalize_query(text):
+    """Canonical form of a question for cache keys: lowercase, single spaces, no trailing punctuation"""
+    return re.sub(r'\s+', ' ', text).strip().lower().rstrip('?!. ')
+
+
+class LRUCache:
+    def __init__(self, maxsize=256, ttl=None, max_bytes=None):
+        """
+        Thread-safe LRU cache with optional expiry
+        maxsize: max number of entries (0 disables the cache)
+        ttl: seconds an entry stays valid, None for no expiry
+        max_bytes: optional bound on the total len() of cached values (for str/bytes values)
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        if self.max_bytes is not None and len(value) > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, expires)
+            if self.max_bytes is not None:
+                self._bytes += len(value)
+            while len(self._data) > self.maxsize or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._data)))
+
+    def discard(self, key):
+        """Remove an entry if present"""
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def _remove(self, key):
+        value, _ = self._data.pop(key)
+        if self.max_bytes is not None:
+            self._bytes -= len(value)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses
+        }
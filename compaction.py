@@ -0,0 +1,434 @@
+"""
+Background compaction of old captures
+A camera shooting every few seconds stores thousands of near-identical rows a day. Once frames are older
+than min_age, runs of consecutive similar frames (cosine similarity to the run's centroid above a threshold,
+no gap longer than max_gap) are merged into one episode row: the normalized mean of their embeddings,
+the description of the frame closest to it (or a model-written summary), and the start / end of the episode.
+The other frames' rows and image files are deleted. Separately, originals are recompressed and then
+evicted (keeping their model-size copy) oldest first while the captures exceed a disk budget. The budget
+counts every image under the capture directory, so it needs a directory of its own: it is ignored for the
+repository's Raspberry-Pi/captures, whose git-tracked sample captures must never be rewritten or deleted.
+
+Progress is checkpointed per shard, so an interrupted run picks up where it stopped; re-running over
+frames that were already merged is a no-op because episode ids are derived from their members. Frames
+stored after a shard's last pass with capture times below its progress (spooled or backfilled uploads)
+make the next run rescan the shard from just before the earliest of them.
+
+python compaction.py --persist-dir chroma_data --capture-dir /var/lib/retrospecs/captures --budget-mb 2048 --dry-run
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+# Rows whose embeddings and documents are fetched at once while walking a shard
+FETCH_CHUNK_ROWS = 1000
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png')
+# Default capture directory, holding the sample captures tracked in git; no disk budget is enforced on it
+SAMPLE_CAPTURE_DIR = Path(__file__).resolve().parent / "Raspberry-Pi" / "captures"
+
+RECLAIMED = REGISTRY.counter(
+    'retrospecs_compaction_reclaimed_total', "Rows and bytes reclaimed by compaction", ['kind'])
+
+
+def episode_id(member_ids):
+    digest = hashlib.sha256('|'.join(member_ids).encode('utf-8')).hexdigest()
+    return f"episode_{digest[:32]}"
+
+
+class Compactor:
+    def __init__(self, db, variants, checkpoint_path, similarity=0.85, max_gap=120.0, max_span=3600.0,
+                 min_age=86400.0, min_frames=2, disk_budget=None, recompress_max_side=1280, recompress_quality=70,
+                 summarize=None, on_change=None):
+        """
+        db: VectorDB whose shards are compacted
+        variants: ImageVariants of the capture directory
+        checkpoint_path: JSON file holding per-shard progress and the last report
+        similarity: min cosine similarity between a frame and its episode's centroid
+        max_gap / max_span: seconds between consecutive frames / from first to last frame of an episode;
+            max_span bounds how far an episode's start timestamp can be from events inside it
+        min_age: seconds; newer frames are never touched
+        min_frames: smaller runs are left as they are
+        disk_budget: bytes allowed for originals (None: no recompression or eviction);
+            needs a dedicated capture directory, so it is ignored for SAMPLE_CAPTURE_DIR
+        recompress_max_side / recompress_quality: JPEG re-encode applied to old originals before evicting any
+        summarize: optional callable(list of descriptions) -> one description for an episode
+        on_change: called after a run that deleted rows (e.g. to reload dedupe indexes)
+        """
+        self.db = db
+        self.variants = variants
+        self.capture_dir = Path(variants.capture_dir)
+        self.checkpoint_path = Path(checkpoint_path)
+        self.similarity = similarity
+        self.max_gap = max_gap
+        self.max_span = max_span
+        self.min_age = min_age
+        self.min_frames = min_frames
+        self.disk_budget = disk_budget
+        if disk_budget is not None and self.capture_dir.resolve() == SAMPLE_CAPTURE_DIR:
+            log.warning("Ignoring the disk budget: %s holds the sample captures tracked in git; "
+                        "point the capture directory elsewhere to enforce one", self.capture_dir)
+            self.disk_budget = None
+        self.recompress_max_side = recompress_max_side
+        self.recompress_quality = recompress_quality
+        self.summarize = summarize
+        self.on_change = on_change
+
+        self._run_lock = threading.Lock()
+        self._would_delete = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # Checkpoint
+
+    def load_checkpoint(self):
+        try:
+            return json.loads(self.checkpoint_path.read_text())
+        except FileNotFoundError:
+            return {'shards': {}, 'added': {}, 'last_report': None}
+
+    def _save_checkpoint(self, checkpoint):
+        self.checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.checkpoint_path.with_name(self.checkpoint_path.name + '.tmp')
+        tmp_path.write_text(json.dumps(checkpoint))
+        os.replace(tmp_path, self.checkpoint_path)
+
+    # Runs
+
+    def run(self, dry_run=False, now=None):
+        """
+        One pass over every shard, then over the capture directory
+        dry_run: report what would be reclaimed without changing anything
+        Returns the report
+        """
+        with self._run_lock:
+            started = time.perf_counter()
+            now = now if now is not None else time.time()
+            checkpoint = self.load_checkpoint()
+            # Dry runs collect the files merging would delete, so the budget pass does not count them
+            self._would_delete = set()
+            report = {
+                'dry_run': dry_run,
+                'rows_before': self.db.count(),
+                # Before merging deletes any files
+                'capture_bytes_before': sum(size for _, size, _ in self._originals()),
+                'episodes': 0,
+                'frames_merged': 0,
+                'files_deleted': 0,
+                'file_bytes_deleted': 0,
+                'index_bytes_reclaimed': 0,
+                'recompressed': 0,
+                'recompressed_bytes_saved': 0,
+                'evicted': 0,
+                'evicted_bytes': 0
+            }
+
+            shards = self.db.shard_items()
+            for key, collection in shards:
+                if self._stop.is_set():
+                    break
+                self._compact_shard(key, collection, now - self.min_age, checkpoint, report, dry_run)
+
+            if report['frames_merged'] and not dry_run:
+                self.db.invalidate()
+                for _, collection in shards:
+                    vacuum = getattr(collection, 'vacuum', None)
+                    if vacuum is not None:
+                        report['index_bytes_reclaimed'] += vacuum()
+                if self.on_change:
+                    self.on_change()
+
+            self._enforce_budget(now - self.min_age, report, dry_run)
+
+            if dry_run:
+                report['rows_after'] = report['rows_before'] - report['frames_merged'] + report['episodes']
+            else:
+                report['rows_after'] = self.db.count()
+            report['rows_reclaimed'] = report['rows_before'] - report['rows_after']
+            report['seconds'] = round(time.perf_counter() - started, 3)
+            report['finished'] = now
+
+            if not dry_run:
+                RECLAIMED.inc(report['rows_reclaimed'], kind='rows')
+                RECLAIMED.inc(report['file_bytes_deleted'] + report['recompressed_bytes_saved']
+                              + report['evicted_bytes'] + report['index_bytes_reclaimed'], kind='bytes')
+                checkpoint['last_report'] = report
+                self._save_checkpoint(checkpoint)
+            return report
+
+    def start(self, interval):
+        """Run every interval seconds in a daemon thread"""
+        def loop():
+            while not self._stop.wait(interval):
+                try:
+                    report = self.run()
+                    log.info("Compaction reclaimed %d rows and %d bytes of captures in %.1fs", report['rows_reclaimed'],
+                             report['file_bytes_deleted'] + report['recompressed_bytes_saved'] + report['evicted_bytes'],
+                             report['seconds'])
+                except Exception:
+                    log.exception("Compaction failed")
+
+        self._thread = threading.Thread(target=loop, name="compaction", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the background thread; a run in progress stops after its current shard"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # Episodes
+
+    def _compact_shard(self, key, collection, cutoff, checkpoint, report, dry_run):
+        shard = f"{key[0]}/{key[1] or ''}"
+        # Progress in capture time, and the newest row (by when it was stored) the last full pass saw
+        watermark = checkpoint['shards'].get(shard, float('-inf'))
+        seen_added = checkpoint.setdefault('added', {}).get(shard, float('-inf'))
+
+        metadata = collection.get(include=['metadatas'])
+        # Files can be shared by rows (the same filename uploaded twice); only delete unreferenced ones
+        references = Counter(m.get('filename') for m in metadata['metadatas'])
+        rows, late, added = [], [], float('-inf')
+        for id_, m in zip(metadata['ids'], metadata['metadatas']):
+            added = max(added, m.get('added', float('-inf')))
+            if m.get('ts') is None or m['ts'] >= cutoff or m.get('episode'):
+                continue
+            rows.append((m['ts'], id_))
+            # Stored since the last pass but taken before its watermark: would never be looked at again
+            if m['ts'] < watermark and m.get('added', float('-inf')) > seen_added:
+                late.append(m['ts'])
+
+        # Rescan from far enough before the earliest late frame that it can join the frames around it
+        scan_from = min(watermark, min(late) - self.max_span) if late else watermark
+        candidates = sorted((ts, id_) for ts, id_ in rows if ts >= scan_from)
+
+        group = []   # rows of the open episode: (id, embedding, document, metadata)
+        centroid = None
+        for start in range(0, len(candidates), FETCH_CHUNK_ROWS):
+            ids = [id_ for _, id_ in candidates[start:start + FETCH_CHUNK_ROWS]]
+            rows = collection.get(ids=ids, include=['embeddings', 'documents', 'metadatas'])
+            by_id = {
+                id_: (id_, np.asarray(embedding, dtype=np.float32), document, meta)
+                for id_, embedding, document, meta in zip(rows['ids'], rows['embeddings'], rows['documents'], rows['metadatas'])
+            }
+
+            for id_ in ids:
+                row = by_id.get(id_)
+                if row is None:
+                    continue   # deleted since the metadata scan
+                vector = row[1] / (np.linalg.norm(row[1]) or 1.0)
+                if group and self._continues(group, centroid, row, vector):
+                    group.append(row)
+                    centroid += vector
+                    continue
+                self._close_episode(collection, group, references, report, dry_run)
+                group, centroid = [row], vector.copy()
+
+            if not dry_run:
+                # Everything before the open episode is done
+                checkpoint['shards'][shard] = group[0][3]['ts'] if group else cutoff
+                self._save_checkpoint(checkpoint)
+            if self._stop.is_set():
+                return
+
+        # The last episode may continue past the cutoff; leave it for the next run unless it has clearly ended
+        if group and cutoff - group[-1][3]['ts'] > self.max_gap:
+            self._close_episode(collection, group, references, report, dry_run)
+            group = []
+        if not dry_run:
+            checkpoint['shards'][shard] = group[0][3]['ts'] if group else cutoff
+            if added > seen_added:
+                checkpoint['added'][shard] = added
+            self._save_checkpoint(checkpoint)
+
+    def _continues(self, group, centroid, row, vector):
+        ts = row[3]['ts']
+        if ts - group[-1][3]['ts'] > self.max_gap or ts - group[0][3]['ts'] > self.max_span:
+            return False
+        return float(vector @ centroid) / float(np.linalg.norm(centroid)) >= self.similarity
+
+    def _close_episode(self, collection, group, references, report, dry_run):
+        if len(group) < self.min_frames:
+            return
+
+        ids = [row[0] for row in group]
+        vectors = np.stack([row[1] / (np.linalg.norm(row[1]) or 1.0) for row in group])
+        representative = vectors.mean(axis=0)
+        representative /= np.linalg.norm(representative) or 1.0
+        # The member closest to the episode's centroid stands in for it: its image, hash and description
+        medoid = group[int(np.argmax(vectors @ representative))]
+
+        first, last = group[0][3], group[-1][3]
+        metadata = {k: v for k, v in medoid[3].items() if k != 'duplicate_of'}
+        metadata.update(
+            timestamp=first['timestamp'], ts=first['ts'],
+            timestamp_end=last['timestamp'], ts_end=last['ts'],
+            frame_count=len(group), episode=True
+        )
+
+        report['episodes'] += 1
+        report['frames_merged'] += len(group)
+        dropped = [row[3]['filename'] for row in group if row[3]['filename'] != metadata['filename']]
+        if dry_run:
+            for filename in set(dropped):
+                references[filename] -= dropped.count(filename)
+                if references[filename] <= 0:
+                    report['files_deleted'] += 1
+                    report['file_bytes_deleted'] += self._size(filename)
+                    self._would_delete.add(self.variants.path(filename))
+            return
+
+        document = medoid[2]
+        if self.summarize:
+            try:
+                document = self.summarize([row[2] for row in group])
+            except Exception as e:
+                log.warning("Could not summarize episode %s, keeping its medoid description: %s", ids[0], e)
+
+        # Write the episode before deleting its frames: a crash in between leaves both, and the next run
+        # rebuilds the same episode id over the same frames
+        collection.upsert(ids=[episode_id(ids)], embeddings=[representative.tolist()], documents=[document],
+                          metadatas=[metadata])
+        collection.delete(ids=ids)
+
+        for filename in dropped:
+            references[filename] -= 1
+            if references[filename] <= 0:
+                freed = self.variants.remove(filename)
+                if freed:
+                    report['files_deleted'] += 1
+                    report['file_bytes_deleted'] += freed
+
+    def _size(self, filename):
+        size = 0
+        for variant in ('original', 'model', 'thumb'):
+            try:
+                size += self.variants.path(filename, variant).stat().st_size
+            except FileNotFoundError:
+                pass
+        return size
+
+    # Disk budget
+
+    def _originals(self):
+        """(mtime, size, path) of every original capture, oldest first"""
+        originals = []
+        for path in self.capture_dir.rglob('*'):
+            if (path.suffix.lower() not in IMAGE_SUFFIXES or self.variants.variant_dir in path.parents
+                    or path in self._would_delete):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            originals.append((stat.st_mtime, stat.st_size, path))
+        originals.sort()
+        return originals
+
+    def _enforce_budget(self, cutoff, report, dry_run):
+        """Recompress, then evict, originals older than cutoff (oldest first) until they fit the budget"""
+        originals = self._originals()
+        total = sum(size for _, size, _ in originals)
+        if self.disk_budget is None or total <= self.disk_budget:
+            report['capture_bytes_after'] = total
+            return
+
+        old = [(mtime, size, path) for mtime, size, path in originals if mtime < cutoff]
+        for mtime, size, path in old:
+            if total <= self.disk_budget:
+                break
+            saved = self._recompress(path, mtime, size, dry_run)
+            if saved:
+                total -= saved
+                report['recompressed'] += 1
+                report['recompressed_bytes_saved'] += saved
+
+        for _, _, path in old:
+            if total <= self.disk_budget:
+                break
+            if not path.exists():
+                continue
+            size = path.stat().st_size
+            if not dry_run:
+                filename = path.relative_to(self.capture_dir).as_posix()
+                try:
+                    # Keep a model-size copy so answers can still show the image
+                    self.variants.read(filename, 'model')
+                except Exception as e:
+                    log.warning("Not evicting %s, could not build its model copy: %s", filename, e)
+                    continue
+                self.variants.remove(filename, variants=('original',))
+            total -= size
+            report['evicted'] += 1
+            report['evicted_bytes'] += size
+
+        report['capture_bytes_after'] = total
+
+    def _recompress(self, path, mtime, size, dry_run):
+        """Re-encode an original at recompress_max_side / recompress_quality; returns the bytes saved"""
+        try:
+            with Image.open(path) as image:
+                if max(image.size) <= self.recompress_max_side:
+                    return 0   # already recompressed (or small to begin with)
+                image.draft('RGB', (self.recompress_max_side, self.recompress_max_side))
+                image = image.convert('RGB')
+            image.thumbnail((self.recompress_max_side, self.recompress_max_side), Image.LANCZOS)
+        except Exception as e:
+            log.warning("Could not recompress %s: %s", path, e)
+            return 0
+
+        tmp_path = path.with_name(path.name + '.part')
+        image.save(tmp_path, format='JPEG', quality=self.recompress_quality, optimize=True)
+        saved = size - tmp_path.stat().st_size
+        if saved <= 0 or dry_run:
+            tmp_path.unlink()
+            return max(saved, 0)
+        os.replace(tmp_path, path)
+        # Keep the capture time, so eviction order and min_age still see the original age
+        os.utime(path, (mtime, mtime))
+        return saved
+
+
+if __name__ == "__main__":
+    from image_variants import ImageVariants
+    from vectorDB import VectorDB
+
+    parser = argparse.ArgumentParser(description="Merge old similar frames into episodes and enforce a disk budget")
+    parser.add_argument('--persist-dir', default=os.getenv('CHROMA_PERSIST_DIR', 'chroma_data'))
+    parser.add_argument('--storage', default=os.getenv('VECTOR_STORE', 'chroma'), choices=['chroma', 'numpy'])
+    parser.add_argument('--capture-dir', default=os.getenv('CAPTURE_DIR', os.path.join("Raspberry-Pi", "captures")))
+    parser.add_argument('--checkpoint', default=None, help="defaults to <persist-dir>/compaction.json")
+    parser.add_argument('--similarity', type=float, default=0.85)
+    parser.add_argument('--max-gap', type=float, default=120.0, help="seconds")
+    parser.add_argument('--max-span', type=float, default=3600.0, help="seconds")
+    parser.add_argument('--min-age-hours', type=float, default=24.0)
+    parser.add_argument('--budget-mb', type=float, default=None, help="disk budget for original captures")
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    db = VectorDB(persist_directory=args.persist_dir, storage=args.storage)
+    compactor = Compactor(
+        db, ImageVariants(args.capture_dir),
+        checkpoint_path=args.checkpoint or os.path.join(args.persist_dir, "compaction.json"),
+        similarity=args.similarity,
+        max_gap=args.max_gap,
+        max_span=args.max_span,
+        min_age=args.min_age_hours * 3600,
+        disk_budget=int(args.budget_mb * 1024 * 1024) if args.budget_mb is not None else None
+    )
+    print(json.dumps(compactor.run(dry_run=args.dry_run), indent=2))
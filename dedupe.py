@@ -0,0 +1,102 @@
+import io
+import threading
+
+from PIL import Image
+
+
+def dhash(image_bytes, hash_size=8):
+    """
+    Compute the difference hash of an encoded image as an int
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    # Let the JPEG decoder downscale while decoding instead of decoding full resolution
+    image.draft('L', (hash_size * 8, hash_size * 8))
+    pixels = list(image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR).getdata())
+
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (right > left)
+    return value
+
+
+def hamming(hash1, hash2):
+    return bin(hash1 ^ hash2).count('1')
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over Hamming distance
+    Each node is [hash, value, {distance: child}]
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, hash_, value):
+        self.size += 1
+        if self.root is None:
+            self.root = [hash_, value, {}]
+            return
+
+        node = self.root
+        while True:
+            distance = hamming(hash_, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [hash_, value, {}]
+                return
+            node = child
+
+    def search(self, hash_, max_distance):
+        """All (distance, hash, value) within max_distance, closest first"""
+        if self.root is None:
+            return []
+
+        matches = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming(hash_, node[0])
+            if distance <= max_distance:
+                matches.append((distance, node[0], node[1]))
+            # Triangle inequality: only children in this band can be within range
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+
+        matches.sort(key=lambda m: m[0])
+        return matches
+
+
+class DedupeIndex:
+    def __init__(self, threshold=5):
+        """
+        Near-duplicate lookup over the perceptual hashes of every stored frame
+        threshold: max Hamming distance (out of 64) for two frames to count as duplicates
+        """
+        self.threshold = threshold
+        self._tree = BKTree()
+        self._lock = threading.Lock()
+
+    def find(self, hash_):
+        """Id of the closest stored frame within the threshold, or None"""
+        with self._lock:
+            matches = self._tree.search(hash_, self.threshold)
+        return matches[0][2] if matches else None
+
+    def add(self, hash_, photo_id):
+        with self._lock:
+            self._tree.add(hash_, photo_id)
+
+    def load(self, hashes):
+        """Bulk-load (hash, photo_id) pairs, e.g. from VectorDB.photo_hashes()"""
+        for hash_, photo_id in hashes:
+            self.add(hash_, photo_id)
+        return self
+
+    def __len__(self):
+        return self._tree.size
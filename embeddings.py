@@ -0,0 +1,130 @@
+import os
+import re
+import zlib
+from typing import List
+
+import numpy as np
+
+from metrics import model_call, record_usage
+from model_client import create_client
+
+OPENAI_EMBEDDING_MODEL = "text-embedding-3-small"
+OPENAI_EMBEDDING_DIM = 1536
+
+# Provider limits for a single embeddings request
+MAX_EMBEDDING_INPUTS = 2048
+MAX_EMBEDDING_TOKENS = 300000
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+# Part of the hashing embedder's name: bump it whenever tokenization, stopwords or weighting change
+# the vectors, so stores built by an earlier version are refused instead of queried with mismatched vectors
+# 1: unigrams and bigrams; 2: stopwords removed
+HASHING_VERSION = 2
+
+# Without IDF weighting, function words would dominate the hashed vectors
+STOPWORDS = frozenset(
+    "a an and are as at be been being by did do does for from had has have i in is it its "
+    "my of on or that the their there this to was were what when where which who with you your".split()
+)
+
+
+class EmbeddingProvider:
+    """
+    Turns texts into fixed-size vectors
+    name and dim are recorded on the collection so stores built with one backend
+    are never queried with another
+    """
+    name = None
+    dim = None
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        raise NotImplementedError
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    def __init__(self, client=None, model=OPENAI_EMBEDDING_MODEL, dim=OPENAI_EMBEDDING_DIM):
+        self.client = client or create_client()
+        self.model = model
+        self.name = f"openai:{model}"
+        self.dim = dim
+
+    def embed(self, texts):
+        """Embed texts, splitting into as few requests as the provider limits allow"""
+        embeddings = []
+        for chunk in self._chunks(texts):
+            with model_call('embed'):
+                response = self.client.embeddings.create(
+                    model=self.model,
+                    input=chunk
+                )
+            record_usage('embed', getattr(response, 'usage', None))
+            embeddings.extend(item.embedding for item in sorted(response.data, key=lambda d: d.index))
+        return embeddings
+
+    @staticmethod
+    def _chunks(texts):
+        chunk, tokens = [], 0
+        for text in texts:
+            # Rough token estimate (~4 characters per token)
+            estimate = len(text) // 4 + 1
+            if chunk and (len(chunk) >= MAX_EMBEDDING_INPUTS or tokens + estimate > MAX_EMBEDDING_TOKENS):
+                yield chunk
+                chunk, tokens = [], 0
+            chunk.append(text)
+            tokens += estimate
+        if chunk:
+            yield chunk
+
+
+class HashingEmbeddingProvider(EmbeddingProvider):
+    def __init__(self, dim=1024, ngram_range=(1, 2)):
+        """
+        Local, offline embedder: signed feature hashing of word unigrams and bigrams
+        (stopwords removed) with sublinear term frequency, L2-normalized
+        Needs no model files or network and embeds a short query in well under a millisecond
+        """
+        self.dim = dim
+        self.ngram_range = ngram_range
+        self.name = f"hashing:{dim}:{ngram_range[0]}-{ngram_range[1]}:v{HASHING_VERSION}"
+
+    def _features(self, text):
+        words = [w for w in _TOKEN_RE.findall(text.lower()) if w not in STOPWORDS]
+        low, high = self.ngram_range
+        for n in range(low, high + 1):
+            for i in range(len(words) - n + 1):
+                # crc32 is stable across processes, unlike hash()
+                yield zlib.crc32(' '.join(words[i:i + n]).encode('utf-8'))
+
+    def embed(self, texts):
+        rows, hashes = [], []
+        for row, text in enumerate(texts):
+            features = list(self._features(text))
+            rows.extend([row] * len(features))
+            hashes.extend(features)
+
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        if hashes:
+            hashes = np.asarray(hashes, dtype=np.uint32)
+            cols = (hashes % self.dim).astype(np.intp)
+            # Top bit picks the sign so collisions tend to cancel instead of pile up
+            signs = np.where(hashes >> 31, -1.0, 1.0).astype(np.float32)
+            np.add.at(matrix, (np.asarray(rows, dtype=np.intp), cols), signs)
+
+        # Sublinear term frequency, then unit length so L2 distance ranks like cosine
+        matrix = np.sign(matrix) * np.log1p(np.abs(matrix))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms == 0, 1.0, norms)
+        return matrix.tolist()
+
+
+def create_embedder(client=None, backend=None):
+    """
+    Embedding provider selected by EMBEDDING_BACKEND: "openai" (default) or "local"
+    """
+    backend = backend or os.getenv('EMBEDDING_BACKEND', 'openai')
+    if backend == 'openai':
+        return OpenAIEmbeddingProvider(client=client)
+    if backend == 'local':
+        return HashingEmbeddingProvider(dim=int(os.getenv('LOCAL_EMBEDDING_DIM', '1024')))
+    raise ValueError(f"Unknown embedding backend {backend}")
@@ -0,0 +1,162 @@
+"""
+Local OpenAI-compatible HTTP server for offline runs and benchmarks
+Serves /v1/chat/completions (plain and streamed) and /v1/embeddings with canned content from FakeOpenAI,
+after a configurable delay and with a configurable fraction of 500 errors
+
+python fake_openai_server.py --port 8100 --latency 0.5 --failure-rate 0.02
+OPENAI_BASE_URL=http://localhost:8100/v1 OPENAI_API_KEY=fake python server.py
+"""
+import argparse
+import base64
+import json
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from model_client import FakeOpenAI
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Set by serve()
+    fake = None
+    token_latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/v1/models':
+            return self._json(200, {"object": "list", "data": [{"id": "gpt-4o-mini", "object": "model"}]})
+        self._json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+        path = self.path.rstrip('/')
+        try:
+            if path == '/v1/chat/completions':
+                return self._chat(body)
+            if path == '/v1/embeddings':
+                return self._embeddings(body)
+        except RuntimeError as e:
+            return self._json(500, {"error": {"message": str(e), "type": "server_error"}})
+        self._json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+    def _chat(self, body):
+        model = body.get('model', 'gpt-4o-mini')
+        # Text parts may be sent as a plain string or as a list of typed parts
+        messages = [
+            dict(m, content=[{'type': 'text', 'text': m['content']}] if isinstance(m['content'], str) else m['content'])
+            for m in body.get('messages', [])
+        ]
+        response = self.fake.chat.completions.create(model=model, messages=messages)
+        content = response.choices[0].message.content
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        if not body.get('stream'):
+            usage = response.usage
+            return self._json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {
+                    "prompt_tokens": usage.prompt_tokens,
+                    "completion_tokens": usage.completion_tokens,
+                    "total_tokens": usage.prompt_tokens + usage.completion_tokens
+                }
+            })
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        def chunk(delta, finish_reason=None):
+            data = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            }
+            self.wfile.write(f"data: {json.dumps(data)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+
+        chunk({"role": "assistant", "content": ""})
+        for word in content.split(' '):
+            if self.token_latency:
+                time.sleep(self.token_latency)
+            chunk({"content": word + ' '})
+        chunk({}, finish_reason="stop")
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _embeddings(self, body):
+        model = body.get('model', 'text-embedding-3-small')
+        response = self.fake.embeddings.create(model=model, input=body.get('input', []))
+
+        data = []
+        for item in response.data:
+            embedding = item.embedding
+            if body.get('encoding_format') == 'base64':
+                # What the openai SDK asks for by default: little-endian float32
+                embedding = base64.b64encode(np.asarray(embedding, dtype='<f4').tobytes()).decode('ascii')
+            data.append({"object": "embedding", "index": item.index, "embedding": embedding})
+
+        tokens = response.usage.prompt_tokens
+        self._json(200, {
+            "object": "list",
+            "data": data,
+            "model": model,
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+        })
+
+    def _json(self, status, data):
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def serve(host='127.0.0.1', port=8100, latency=0.0, failure_rate=0.0, token_latency=0.0, dim=1536, seed=None):
+    """
+    Build the server (call serve_forever() on it)
+    latency: seconds slept per request, failure_rate: fraction of requests answered with a 500,
+    token_latency: extra seconds between streamed chunks
+    """
+    handler = type('Handler', (FakeOpenAIHandler,), {
+        'fake': FakeOpenAI(latency=latency, failure_rate=failure_rate, dim=dim, seed=seed),
+        'token_latency': token_latency
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds per model call")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="fraction of calls that return a 500")
+    parser.add_argument('--token-latency', type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument('--dim', type=int, default=1536, help="embedding dimension")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, args.latency, args.failure_rate, args.token_latency, args.dim, args.seed)
+    print(f"Fake OpenAI server on http://{args.host}:{args.port}/v1", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,135 @@
+import base64
+import io
+import os
+from pathlib import Path
+
+from PIL import Image
+
+from cache import LRUCache
+
+# Variants built from each original, in build order
+DERIVED_VARIANTS = ('model', 'thumb')
+
+
+class ImageVariants:
+    def __init__(self, capture_dir, model_max_side=768, model_quality=80, thumb_max_side=256, thumb_quality=70,
+                 cache_bytes=64 * 1024 * 1024):
+        """
+        Derived copies of each capture, written next to it in <capture_dir>/variants
+        model: downscaled JPEG sent to the vision model
+        thumb: small JPEG for clients
+        Hot variants are kept base64-encoded in a size-bounded LRU (cache_bytes)
+        """
+        self.capture_dir = Path(capture_dir)
+        # Created on the first write, so building an ImageVariants touches nothing on disk
+        self.variant_dir = self.capture_dir / "variants"
+
+        self.sizes = {
+            'model': (model_max_side, model_quality),
+            'thumb': (thumb_max_side, thumb_quality)
+        }
+        self.cache = LRUCache(maxsize=4096, max_bytes=cache_bytes)
+
+    def path(self, filename, variant='original'):
+        if variant == 'original':
+            return self.capture_dir / filename
+        if variant not in self.sizes:
+            raise ValueError(f"Unknown image variant {variant}")
+        # Captures in subdirectories (one per household / camera) get the same subdirectories under variants/
+        filename = Path(filename)
+        return self.variant_dir / filename.parent / f"{filename.stem}.{variant}.jpg"
+
+    def ingest(self, filename, image_bytes):
+        """
+        Store the original and build every derived variant from the same bytes
+        A re-upload replaces the original and its variants together; if the variants can't be built,
+        stale ones from an earlier upload are removed rather than left next to the new original
+        Returns the model-ready JPEG bytes
+        """
+        original = self.path(filename)
+        # Already there when the upload was streamed to disk, or when rebuilding a missing variant
+        if not self._same(original, image_bytes):
+            self._write(original, image_bytes)
+        self.cache.discard((filename, 'original'))
+
+        try:
+            encoded = {variant: self._encode(image_bytes, *self.sizes[variant]) for variant in DERIVED_VARIANTS}
+        except Exception:
+            self.remove(filename, DERIVED_VARIANTS)
+            raise
+
+        for variant, data in encoded.items():
+            self._write(self.path(filename, variant), data)
+            self.cache.set((filename, variant), base64.b64encode(data).decode('utf-8'))
+
+        return encoded['model']
+
+    def read(self, filename, variant='original'):
+        """
+        Bytes of a variant, building it from the original if it is missing
+        An original evicted by compaction.py is served as its model copy
+        """
+        path = self.path(filename, variant)
+        if not path.exists():
+            if variant == 'original':
+                path = self.fallback(filename)
+            else:
+                self.ingest(filename, self.path(filename).read_bytes())
+        return path.read_bytes()
+
+    def fallback(self, filename):
+        """Path to serve for an original: the original, or its model copy once the original was evicted"""
+        original = self.path(filename)
+        if original.exists():
+            return original
+        model = self.path(filename, 'model')
+        return model if model.exists() else original
+
+    def remove(self, filename, variants=('original',) + DERIVED_VARIANTS):
+        """Delete stored copies of a capture; returns the bytes freed"""
+        freed = 0
+        for variant in variants:
+            path = self.path(filename, variant)
+            try:
+                size = path.stat().st_size
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            freed += size
+            self.cache.discard((filename, variant))
+        return freed
+
+    def base64(self, filename, variant='original'):
+        """Base64 of a variant, served from memory when hot"""
+        key = (filename, variant)
+        encoded = self.cache.get(key)
+        if encoded is None:
+            encoded = base64.b64encode(self.read(filename, variant)).decode('utf-8')
+            self.cache.set(key, encoded)
+        return encoded
+
+    @staticmethod
+    def _encode(image_bytes, max_side, quality):
+        image = Image.open(io.BytesIO(image_bytes))
+        # Let the JPEG decoder do most of the downscaling instead of decoding full resolution
+        image.draft('RGB', (max_side, max_side))
+        resized = image.convert('RGB')
+        resized.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        out = io.BytesIO()
+        resized.save(out, format='JPEG', quality=quality, optimize=True)
+        return out.getvalue()
+
+    @staticmethod
+    def _same(path, data):
+        try:
+            return path.stat().st_size == len(data) and path.read_bytes() == data
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def _write(path, data):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + '.part')
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
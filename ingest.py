@@ -0,0 +1,154 @@
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+JOBS = REGISTRY.counter('retrospecs_ingest_jobs_total', "Ingest jobs by outcome", ['status'])
+JOB_ATTEMPTS = REGISTRY.counter('retrospecs_ingest_attempts_total', "Ingest job attempts by outcome", ['status'])
+
+
+class QueueFull(Exception):
+    """Raised when the ingest queue is at capacity"""
+
+
+def is_transient(exc):
+    """
+    Whether a failed attempt is worth retrying: model, network and store hiccups are;
+    bad input (an unparseable timestamp, a missing file, a 4xx from the model API) fails the same way every time
+    """
+    status = getattr(exc, 'status_code', None)
+    if isinstance(status, int) and 400 <= status < 500:
+        return status in (408, 409, 429)
+    return not isinstance(exc, (ValueError, TypeError, LookupError, FileNotFoundError))
+
+
+class IngestQueue:
+    def __init__(self, handler, workers=4, maxsize=64, max_retries=3, retry_backoff=0.5, history_size=1000,
+                 retryable=is_transient):
+        """
+        Bounded job queue with a pool of worker threads
+        handler: callable run by a worker for each job payload; its return value is stored as the result
+        workers: number of worker threads
+        maxsize: max queued jobs before submit() raises QueueFull
+        max_retries: extra attempts after a failure, with exponential backoff
+        retryable: callable(exception) -> bool; other failures end the job at once
+        history_size: how many finished jobs to remember for status lookups
+        """
+        self.handler = handler
+        self.workers = workers
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.retryable = retryable
+        self.history_size = history_size
+
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"ingest-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        """Let queued jobs finish, then stop the workers"""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, payload):
+        """Queue a job and return its id"""
+        job_id = uuid.uuid4().hex
+        job = {
+            'id': job_id,
+            'status': 'queued',
+            'attempts': 0,
+            'created': time.time(),
+            'started': None,
+            'finished': None,
+            'result': None,
+            'error': None
+        }
+
+        with self._lock:
+            self._jobs[job_id] = job
+            self._trim_history()
+
+        try:
+            self._queue.put_nowait((job_id, payload))
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job_id]
+            JOBS.inc(status='rejected')
+            raise QueueFull("Ingest queue is full")
+
+        return job_id
+
+    def status(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def join(self):
+        """Block until every queued job has been processed"""
+        self._queue.join()
+
+    def _trim_history(self):
+        # Drop the oldest finished jobs; queued/running jobs are always kept
+        excess = len(self._jobs) - self.history_size
+        if excess <= 0:
+            return
+        for job_id in [j for j, job in self._jobs.items() if job['finished']][:excess]:
+            del self._jobs[job_id]
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            self._jobs[job_id].update(fields)
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+
+            job_id, payload = item
+            try:
+                self._run(job_id, payload)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job_id, payload):
+        self._update(job_id, started=time.time())
+        for attempt in range(1, self.max_retries + 2):
+            self._update(job_id, status='running', attempts=attempt)
+            try:
+                result = self.handler(payload)
+            except Exception as e:
+                retry = attempt <= self.max_retries and self.retryable(e)
+                log.warning("Ingest job %s attempt %d failed%s: %s", job_id, attempt, "" if retry else ", not retrying", e)
+                JOB_ATTEMPTS.inc(status='failed')
+                if not retry:
+                    self._update(job_id, status='failed', error=str(e), finished=time.time())
+                    JOBS.inc(status='failed')
+                    return
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+            else:
+                self._update(job_id, status='done', result=result, finished=time.time())
+                JOB_ATTEMPTS.inc(status='done')
+                JOBS.inc(status='done')
+                return
@@ -0,0 +1,214 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Upper bounds (seconds) for latency histograms, from cache hits up to slow model calls
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_NULL_TIMER = nullcontext()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + [f'{n}="{v}"' for n, v in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, help, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(n, '') for n in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, registry, name, help, labelnames=()):
+        super().__init__(registry, name, help, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(v)}" for key, v in values]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}   # label key -> [per-bucket counts (+Inf last), sum]
+
+    def observe(self, value, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def time(self, **labels):
+        """Context manager that observes the seconds spent in the block"""
+        if not self.registry.enabled:
+            return _NULL_TIMER
+        return self._timer(labels)
+
+    @contextmanager
+    def _timer(self, labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', _number(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Callback(_Metric):
+    """
+    Gauge or counter read at scrape time, for values that are already tracked elsewhere
+    (queue depth, cache hit counts); costs nothing on the hot path
+    fn returns a number, or a dict of label-value tuple -> number
+    """
+
+    def __init__(self, registry, name, help, fn, labelnames=(), kind='gauge'):
+        super().__init__(registry, name, help, labelnames)
+        self.fn = fn
+        self.kind = kind
+
+    def _samples(self):
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(v)}" for key, v in values.items()]
+
+
+class Registry:
+    def __init__(self, enabled=True):
+        """
+        Metrics exported in the Prometheus text format
+        When disabled, observe()/inc() return immediately and time() is a no-op context manager
+        """
+        self.enabled = enabled
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            # Re-importing a module (e.g. benchmarks) must not duplicate its metrics
+            existing = self._metrics.get(metric.name)
+            if existing is not None and type(existing) is type(metric):
+                if isinstance(metric, Callback):
+                    existing.fn = metric.fn
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(self, name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, help, labelnames, buckets))
+
+    def gauge_callback(self, name, help, fn, labelnames=()):
+        return self._register(Callback(self, name, help, fn, labelnames, kind='gauge'))
+
+    def counter_callback(self, name, help, fn, labelnames=()):
+        return self._register(Callback(self, name, help, fn, labelnames, kind='counter'))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# Process-wide registry; METRICS_ENABLED=0 turns all recording off
+REGISTRY = Registry(enabled=os.getenv('METRICS_ENABLED', '1').lower() not in ('0', 'false', 'no'))
+
+# Shared by the server and the modules it calls into
+STAGE_SECONDS = REGISTRY.histogram(
+    'retrospecs_stage_seconds', "Time spent in each stage of the ingest and query paths", ['stage'])
+MODEL_SECONDS = REGISTRY.histogram(
+    'retrospecs_model_request_seconds', "Latency of model API calls", ['call'])
+MODEL_ERRORS = REGISTRY.counter(
+    'retrospecs_model_errors_total', "Model API calls that raised", ['call'])
+MODEL_TOKENS = REGISTRY.counter(
+    'retrospecs_model_tokens_total', "Tokens reported by the model API", ['call', 'type'])
+
+
+@contextmanager
+def model_call(call):
+    """Time a model API call and count it if it raises"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        MODEL_ERRORS.inc(call=call)
+        raise
+    finally:
+        MODEL_SECONDS.observe(time.perf_counter() - start, call=call)
+
+
+def record_usage(call, usage):
+    """Count the prompt/completion tokens of a model response's usage block (if it has one)"""
+    if usage is None or not REGISTRY.enabled:
+        return
+    for kind in ('prompt_tokens', 'completion_tokens'):
+        tokens = getattr(usage, kind, None)
+        if tokens:
+            MODEL_TOKENS.inc(tokens, call=call, type=kind.split('_')[0])
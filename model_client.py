@@ -0,0 +1,90 @@
+import hashlib
+import math
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+EMBEDDING_DIM = 1536
+
+
+class FakeOpenAI:
+    """
+    Local stand-in for the OpenAI client so the server can run (and be benchmarked) offline.
+    Mimics the two calls we use: chat.completions.create and embeddings.create
+    latency: seconds slept per call, failure_rate: fraction of calls that raise
+    """
+
+    def __init__(self, latency=0.0, failure_rate=0.0, dim=EMBEDDING_DIM, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.dim = dim
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = {'chat': 0, 'embeddings': 0}
+
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat_create))
+        self.embeddings = SimpleNamespace(create=self._embeddings_create)
+
+    def _call(self, kind):
+        with self._lock:
+            self.calls[kind] += 1
+            fail = self._random.random() < self.failure_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise RuntimeError(f"Fake {kind} failure")
+
+    def _chat_create(self, model, messages, stream=False, **kwargs):
+        self._call('chat')
+        text = ''
+        for part in messages[-1]['content']:
+            if part.get('type') == 'text':
+                text = part['text']
+        content = f"Fake description of an image ({hashlib.sha1(text.encode()).hexdigest()[:8]})."
+        if stream:
+            return self._stream_chunks(content)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(prompt_tokens=len(text.split()), completion_tokens=len(content.split()))
+        )
+
+    def _stream_chunks(self, content):
+        for word in content.split(' '):
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word + ' '))])
+
+    def _embeddings_create(self, model, input, **kwargs):
+        self._call('embeddings')
+        texts = [input] if isinstance(input, str) else list(input)
+        return SimpleNamespace(
+            data=[SimpleNamespace(index=i, embedding=self.fake_embedding(t)) for i, t in enumerate(texts)],
+            usage=SimpleNamespace(prompt_tokens=sum(len(t.split()) for t in texts))
+        )
+
+    def fake_embedding(self, text):
+        """Deterministic unit vector derived from the text"""
+        rng = random.Random(hashlib.sha256(text.encode('utf-8')).digest())
+        vec = [rng.gauss(0, 1) for _ in range(self.dim)]
+        norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+        return [v / norm for v in vec]
+
+
+def create_client():
+    """
+    Return the model client used by the server and VectorDB.
+    Set FAKE_OPENAI=1 to use the local FakeOpenAI instead of the real API,
+    or OPENAI_BASE_URL to talk to another OpenAI-compatible server (e.g. fake_openai_server.py).
+    """
+    if os.getenv('FAKE_OPENAI', '').lower() in ('1', 'true', 'yes'):
+        return FakeOpenAI(
+            latency=float(os.getenv('FAKE_OPENAI_LATENCY', '0')),
+            failure_rate=float(os.getenv('FAKE_OPENAI_FAILURE_RATE', '0'))
+        )
+
+    from openai import OpenAI
+    return OpenAI(api_key=os.getenv('OPENAI_API_KEY'), base_url=os.getenv('OPENAI_BASE_URL') or None)
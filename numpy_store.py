@@ -0,0 +1,465 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from functools import reduce
+from pathlib import Path
+
+import numpy as np
+
+# Rows scored per matrix-vector product; small blocks keep the float32 temporary in cache
+SCORE_BLOCK_ROWS = 512
+MIN_CAPACITY = 1024
+
+_OPS = {
+    '$eq': lambda a, b: a == b,
+    '$ne': lambda a, b: a != b,
+    '$gt': lambda a, b: a > b,
+    '$gte': lambda a, b: a >= b,
+    '$lt': lambda a, b: a < b,
+    '$lte': lambda a, b: a <= b,
+}
+
+
+def _sibling(path, suffix):
+    return path.with_name(f"{path.name}.{suffix}")
+
+
+def _dir_bytes(path):
+    return sum(p.stat().st_size for p in path.iterdir() if p.is_file())
+
+
+def _finish_vacuum(path):
+    """Clean up after a vacuum() interrupted part-way: keep whichever complete copy is in place"""
+    old, staging = _sibling(path, 'old'), _sibling(path, 'vacuum')
+    if old.exists():
+        if path.exists():
+            shutil.rmtree(old)
+        else:
+            os.replace(old, path)
+    if staging.exists():
+        shutil.rmtree(staging)
+
+
+class NumpyCollection:
+    """
+    Single-file-per-kind vector store with the subset of the Chroma collection API VectorDB uses
+    vectors.bin: memory-mapped (capacity, dim) int8 (scaled per row) or float16 matrix
+    aux.bin: memory-mapped (capacity, 2) float32 of [squared norm, int8 scale] per row
+    meta.jsonl: append-only log of puts and deletes; the last entry for an id wins
+    documents.jsonl: append-only documents, read by offset so loading never parses them
+    Queries are exact: one blocked matrix-vector product over the rows that pass the filter
+    """
+
+    def __init__(self, path, name, metadata=None, dtype='int8'):
+        self.path = Path(path)
+        _finish_vacuum(self.path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.name = name
+
+        self._lock = threading.RLock()
+        self._info_path = self.path / "collection.json"
+        self._meta_path = self.path / "meta.jsonl"
+        self._docs_path = self.path / "documents.jsonl"
+        self._vectors_path = self.path / "vectors.bin"
+        self._aux_path = self.path / "aux.bin"
+
+        if self._info_path.exists():
+            info = json.loads(self._info_path.read_text())
+        else:
+            info = {'dim': None, 'dtype': dtype, 'metadata': metadata or {}}
+            self._info_path.write_text(json.dumps(info))
+        self.dim = info['dim']
+        self.dtype = np.dtype(info['dtype'])
+        self.metadata = info['metadata']
+
+        self._ids = []            # row -> id
+        self._rows = {}           # id -> row
+        self._offsets = []        # row -> byte offset of its document in documents.jsonl
+        self._metadatas = []      # row -> metadata dict
+        self._ts = np.zeros(0, dtype=np.float64)
+        self._valid = np.zeros(0, dtype=bool)
+        self._capacity = 0
+        self._vectors = None
+        self._aux = None
+
+        self._open()
+
+    # Persistence
+
+    def _open(self):
+        self._capacity = 0
+        self._vectors = None
+        self._aux = None
+        self._load()
+        self._meta_file = open(self._meta_path, 'ab')
+        self._docs_file = open(self._docs_path, 'ab')
+        self._reader = open(self._docs_path, 'rb')
+
+    def _close(self):
+        for f in (self._meta_file, self._docs_file, self._reader):
+            f.close()
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._aux.flush()
+        self._vectors = None
+        self._aux = None
+
+    def _load(self):
+        entries = []
+        if self._meta_path.exists():
+            data = self._meta_path.read_bytes()
+            # Anything after the last newline is a torn write from a crash; drop it
+            end = data.rfind(b'\n') + 1
+            if end != len(data):
+                with open(self._meta_path, 'r+b') as f:
+                    f.truncate(end)
+            lines = data[:end].splitlines()
+            try:
+                # One parse for the whole log is much faster than a json.loads per line
+                entries = json.loads(b'[' + b','.join(lines) + b']')
+            except ValueError:
+                for line in lines:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        break
+
+        rows = {}
+        live = {}
+        size = 0
+        for entry in entries:
+            if entry['op'] == 'put':
+                row = entry['row']
+                old = rows.get(entry['id'])
+                if old is not None and old != row:
+                    live.pop(old, None)
+                rows[entry['id']] = row
+                live[row] = entry
+                size = max(size, row + 1)
+            else:
+                row = rows.pop(entry['id'], None)
+                if row is not None:
+                    live.pop(row, None)
+
+        capacity = max(size, MIN_CAPACITY)
+        self._ids = [None] * size
+        self._offsets = [0] * size
+        self._metadatas = [None] * size
+        self._ts = np.full(capacity, np.nan)
+        self._valid = np.zeros(capacity, dtype=bool)
+        self._rows = rows
+        for row, entry in live.items():
+            self._ids[row] = entry['id']
+            self._offsets[row] = entry['doc']
+            self._metadatas[row] = entry['metadata']
+        if live:
+            live_rows = np.fromiter(live.keys(), dtype=np.intp, count=len(live))
+            ts = [entry['metadata'].get('ts') for entry in live.values()]
+            self._ts[live_rows] = [t if isinstance(t, (int, float)) else np.nan for t in ts]
+            self._valid[live_rows] = True
+
+        if self.dim is not None and self._vectors_path.exists():
+            self._capacity = os.path.getsize(self._vectors_path) // (self.dim * self.dtype.itemsize)
+            if self._capacity:
+                self._map()
+        self._size = size
+
+    def _place(self, row, id_, metadata, offset):
+        if row >= len(self._ids):
+            grow = row + 1 - len(self._ids)
+            self._ids.extend([None] * grow)
+            self._offsets.extend([0] * grow)
+            self._metadatas.extend([None] * grow)
+        if row >= len(self._ts):
+            # Grow geometrically so appends stay amortized O(1)
+            grow = max(row + 1 - len(self._ts), len(self._ts), MIN_CAPACITY)
+            self._ts = np.concatenate([self._ts, np.full(grow, np.nan)])
+            self._valid = np.concatenate([self._valid, np.zeros(grow, dtype=bool)])
+
+        old = self._rows.get(id_)
+        if old is not None and old != row:
+            self._valid[old] = False
+        self._ids[row] = id_
+        self._rows[id_] = row
+        self._offsets[row] = offset
+        self._metadatas[row] = metadata
+        ts = metadata.get('ts') if metadata else None
+        self._ts[row] = ts if isinstance(ts, (int, float)) else np.nan
+        self._valid[row] = True
+
+    def _map(self):
+        self._vectors = np.memmap(self._vectors_path, dtype=self.dtype, mode='r+', shape=(self._capacity, self.dim))
+        self._aux = np.memmap(self._aux_path, dtype=np.float32, mode='r+', shape=(self._capacity, 2))
+
+    def _ensure_capacity(self, rows):
+        if rows <= self._capacity:
+            return
+        capacity = max(MIN_CAPACITY, self._capacity * 2, rows)
+        for path, row_bytes in ((self._vectors_path, self.dim * self.dtype.itemsize), (self._aux_path, 8)):
+            with open(path, 'ab') as f:
+                f.truncate(capacity * row_bytes)
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._aux.flush()
+        self._capacity = capacity
+        self._map()
+
+    # Chroma-compatible API
+
+    def count(self):
+        return int(self._valid[:self._size].sum())
+
+    def modify(self, metadata=None, **kwargs):
+        with self._lock:
+            if metadata is not None:
+                self.metadata = metadata
+            self._write_info()
+
+    def _write_info(self):
+        tmp_path = self._info_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps({'dim': self.dim, 'dtype': self.dtype.name, 'metadata': self.metadata}))
+        os.replace(tmp_path, self._info_path)
+
+    def add(self, ids, embeddings, documents=None, metadatas=None):
+        existing = [id_ for id_ in ids if id_ in self._rows]
+        if existing:
+            raise ValueError(f"Ids already exist: {existing[:3]}")
+        self.upsert(ids, embeddings, documents, metadatas)
+
+    def upsert(self, ids, embeddings, documents=None, metadatas=None):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if vectors.ndim != 2 or len(vectors) != len(ids):
+            raise ValueError("Expected one embedding per id")
+        documents = documents or [None] * len(ids)
+        metadatas = metadatas or [{}] * len(ids)
+
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._write_info()
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match collection dimension {self.dim}")
+
+            # Updates overwrite their row in place; new ids are appended
+            rows = []
+            for id_ in ids:
+                row = self._rows.get(id_)
+                if row is None:
+                    row = self._size
+                    self._size += 1
+                rows.append(row)
+            self._ensure_capacity(self._size)
+
+            rows_array = np.asarray(rows)
+            if self.dtype == np.int8:
+                scales = np.abs(vectors).max(axis=1) / 127.0
+                scales[scales == 0] = 1.0
+                quantized = np.round(vectors / scales[:, None]).astype(np.int8)
+                self._vectors[rows_array] = quantized
+                stored = quantized.astype(np.float32) * scales[:, None]
+            else:
+                scales = np.ones(len(ids), dtype=np.float32)
+                self._vectors[rows_array] = vectors.astype(self.dtype)
+                stored = self._vectors[rows_array].astype(np.float32)
+            self._aux[rows_array, 0] = np.einsum('ij,ij->i', stored, stored)
+            self._aux[rows_array, 1] = scales
+            self._vectors.flush()
+            self._aux.flush()
+
+            offsets = []
+            for document in documents:
+                offsets.append(self._docs_file.tell())
+                self._docs_file.write(json.dumps(document).encode('utf-8') + b'\n')
+            self._docs_file.flush()
+
+            # The log line is written last, so a logged row always has its vector and document
+            for row, id_, offset, metadata in zip(rows, ids, offsets, metadatas):
+                self._meta_file.write(json.dumps(
+                    {'op': 'put', 'row': row, 'id': id_, 'doc': offset, 'metadata': metadata}
+                ).encode('utf-8') + b'\n')
+                self._place(row, id_, metadata, offset)
+            self._meta_file.flush()
+
+    def delete(self, ids=None, where=None):
+        with self._lock:
+            if where is not None:
+                ids = [self._ids[row] for row in np.flatnonzero(self._mask(where))]
+            for id_ in ids or []:
+                row = self._rows.pop(id_, None)
+                if row is None:
+                    continue
+                self._valid[row] = False
+                self._meta_file.write(json.dumps({'op': 'del', 'id': id_}).encode('utf-8') + b'\n')
+            self._meta_file.flush()
+
+    def vacuum(self):
+        """
+        Rewrite the collection with only its live rows
+        Deletes leave their vector row, log entries and document behind; this reclaims that space.
+        The new files are built in a sibling directory and swapped in, so a crash leaves one complete copy
+        Returns the bytes freed
+        """
+        with self._lock:
+            before = _dir_bytes(self.path)
+            live = np.flatnonzero(self._valid[:self._size])
+            staging = _sibling(self.path, 'vacuum')
+            shutil.rmtree(staging, ignore_errors=True)
+            staging.mkdir()
+
+            with open(staging / "documents.jsonl", 'wb') as docs, open(staging / "meta.jsonl", 'wb') as meta:
+                for new_row, row in enumerate(live):
+                    offset = docs.tell()
+                    docs.write(json.dumps(self._document(row)).encode('utf-8') + b'\n')
+                    meta.write(json.dumps({
+                        'op': 'put', 'row': new_row, 'id': self._ids[row], 'doc': offset, 'metadata': self._metadatas[row]
+                    }).encode('utf-8') + b'\n')
+
+            if self._vectors is not None:
+                capacity = max(MIN_CAPACITY, len(live))
+                for name, source, width, dtype in (("vectors.bin", self._vectors, self.dim, self.dtype),
+                                                   ("aux.bin", self._aux, 2, np.float32)):
+                    target = np.memmap(staging / name, dtype=dtype, mode='w+', shape=(capacity, width))
+                    target[:len(live)] = source[live]
+                    target.flush()
+                    del target
+            shutil.copyfile(self._info_path, staging / "collection.json")
+
+            self._close()
+            old = _sibling(self.path, 'old')
+            os.replace(self.path, old)
+            os.replace(staging, self.path)
+            shutil.rmtree(old)
+            self._open()
+
+            return before - _dir_bytes(self.path)
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=('documents', 'metadatas')):
+        with self._lock:
+            if ids is not None:
+                rows = [self._rows[id_] for id_ in ids if id_ in self._rows]
+                if where is not None:
+                    mask = self._mask(where)
+                    rows = [row for row in rows if mask[row]]
+            else:
+                rows = list(np.flatnonzero(self._mask(where)))
+            rows = rows[offset or 0:][:limit] if limit is not None else rows[offset or 0:]
+            return self._rows_result(rows, include)
+
+    def query(self, query_embeddings, n_results=10, where=None, include=('documents', 'metadatas', 'distances')):
+        with self._lock:
+            mask = self._mask(where)
+            candidates = np.flatnonzero(mask)
+
+            result = {'ids': [], 'documents': [], 'metadatas': [], 'distances': [], 'embeddings': []}
+            for query in np.asarray(query_embeddings, dtype=np.float32):
+                distances = self._distances(candidates, query)
+                k = min(n_results, len(candidates))
+                if k == 0:
+                    top = np.zeros(0, dtype=np.intp)
+                else:
+                    top = np.argpartition(distances, k - 1)[:k]
+                    top = top[np.argsort(distances[top])]
+
+                rows = candidates[top]
+                one = self._rows_result(rows, include)
+                for key in ('ids', 'documents', 'metadatas', 'embeddings'):
+                    result[key].append(one.get(key))
+                result['distances'].append(distances[top].tolist() if 'distances' in include else None)
+            return result
+
+    # Internals
+
+    def _distances(self, rows, query):
+        """Squared L2 distance from query to each row (same metric as Chroma's default)"""
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.float32)
+        dots = np.empty(len(rows), dtype=np.float32)
+        contiguous = len(rows) == self._size and len(rows) > 0 and rows[-1] == self._size - 1
+        for start in range(0, len(rows), SCORE_BLOCK_ROWS):
+            block_rows = rows[start:start + SCORE_BLOCK_ROWS]
+            # Unfiltered scans read straight slices of the memmap instead of gathering rows
+            block = (self._vectors[block_rows[0]:block_rows[-1] + 1] if contiguous else self._vectors[block_rows])
+            scores = block.astype(np.float32) @ query
+            if self.dtype == np.int8:
+                scores *= self._aux[block_rows, 1]
+            dots[start:start + len(block_rows)] = scores
+        return self._aux[rows, 0] + float(query @ query) - 2 * dots
+
+    def _rows_result(self, rows, include):
+        rows = [int(row) for row in rows]
+        result = {'ids': [self._ids[row] for row in rows]}
+        if 'metadatas' in include:
+            result['metadatas'] = [self._metadatas[row] for row in rows]
+        if 'documents' in include:
+            result['documents'] = [self._document(row) for row in rows]
+        if 'embeddings' in include:
+            embeddings = self._vectors[rows].astype(np.float32) if rows else np.zeros((0, self.dim or 0), np.float32)
+            if self.dtype == np.int8 and rows:
+                embeddings *= self._aux[rows, 1][:, None]
+            result['embeddings'] = list(embeddings)
+        else:
+            result['embeddings'] = None
+        return result
+
+    def _document(self, row):
+        self._reader.seek(self._offsets[row])
+        return json.loads(self._reader.readline())
+
+    def _mask(self, where):
+        mask = self._valid[:self._size].copy()
+        if where:
+            mask &= self._condition(where)
+        return mask
+
+    def _condition(self, where):
+        if '$and' in where:
+            return reduce(np.logical_and, [self._condition(w) for w in where['$and']])
+        if '$or' in where:
+            return reduce(np.logical_or, [self._condition(w) for w in where['$or']])
+
+        (key, cond), = where.items()
+        if not isinstance(cond, dict):
+            cond = {'$eq': cond}
+        (op, value), = cond.items()
+
+        if key == 'ts' and op in _OPS:
+            # Timestamps live in a float array, so time windows are evaluated vectorized
+            with np.errstate(invalid='ignore'):
+                return _OPS[op](self._ts[:self._size], value)
+
+        values = [m.get(key) if m else None for m in self._metadatas[:self._size]]
+        if op == '$in':
+            return np.array([v in value for v in values], dtype=bool)
+        if op == '$nin':
+            return np.array([v not in value for v in values], dtype=bool)
+        return np.array([v is not None and _OPS[op](v, value) for v in values], dtype=bool)
+
+
+class NumpyClient:
+    def __init__(self, path=None, dtype='int8'):
+        """
+        Drop-in for the parts of chromadb's client VectorDB uses
+        path: directory holding one subdirectory per collection (a temporary directory if None)
+        dtype: 'int8' or 'float16' storage for new collections; the float16 scan converts every block
+            to float32 first and is several times slower
+        """
+        self.path = Path(path or tempfile.mkdtemp(prefix="numpy_store_"))
+        self.dtype = dtype
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def get_or_create_collection(self, name, metadata=None):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = NumpyCollection(self.path / name, name, metadata=metadata, dtype=self.dtype)
+            return self._collections[name]
+
+    def list_collections(self):
+        """Every collection stored under path"""
+        names = sorted(
+            p.parent.name for p in self.path.glob("*/collection.json")
+            if not p.parent.name.endswith(('.vacuum', '.old'))
+        )
+        return [self.get_or_create_collection(name) for name in names]
@@ -1,140 +1,782 @@
+"""
+Flask API server
+Run with `python server.py`, or `gunicorn 'server:create_app()'`
+Importing this module only reads configuration; create_app() starts the ingest workers and a warm-up
+thread that builds the model client and opens the store. /healthz answers immediately, /readyz once the
+store is open, and the routes that need the store return 503 until then
+"""
+import time
+
+# Taken before the other imports, so the startup timings reported by /readyz include them
+STARTED = time.perf_counter()
+
+import contextvars
 import datetime
+import logging
+import math
 import os
 import json
-from flask import Flask, request
-import numpy as np
-import cv2
-from PIL import Image
-import io
+import threading
+import uuid
+from contextlib import contextmanager
+from flask import Blueprint, Flask, Response, g, request, send_from_directory, stream_with_context, url_for
 import base64
 from pathlib import Path
-from openai import OpenAI
 from dotenv import load_dotenv
-import chromadb
-from vectorDB import VectorDB
+from vectorDB import DEFAULT_HOUSEHOLD, VectorDB, check_device_id, to_epoch
 from flask_cors import CORS
-
-db = VectorDB()
+from ingest import IngestQueue, QueueFull
+from model_client import create_client
+from cache import LRUCache, normalize_query
+from dedupe import DedupeIndex, dhash, hamming
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.security import safe_join
+from werkzeug.utils import secure_filename
+from image_variants import ImageVariants
+from compaction import Compactor
+from metrics import REGISTRY, STAGE_SECONDS, model_call, record_usage
 
 load_dotenv()
 
-app = Flask(__name__)
-CORS(app)
+# Id of the request being handled (or of the request that queued the ingest job), added to every log line
+request_id_var = contextvars.ContextVar('request_id', default='-')
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+logging.basicConfig(
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s %(levelname)s %(name)s request_id=%(request_id)s %(message)s'
+)
+for handler in logging.getLogger().handlers:
+    handler.addFilter(RequestIdFilter())
+log = logging.getLogger('server')
+
+# Model client, store and compactor: built by warm_up() on a background thread (see create_app)
+client = None
+db = None
+compactor = None
+
+# 'starting', 'ready' or 'failed', with the error that stopped the warm-up
+warmup = {'status': 'starting', 'error': None}
+# Seconds from STARTED until the end of each startup phase
+startup = {'import': None, 'store': None, 'ready': None, 'seed': None}
 
-client = OpenAI(
-    api_key=os.getenv('OPENAI_API_KEY')
+# Optional recency reranking for /response, in seconds (0 disables)
+RECENCY_HALF_LIFE = float(os.getenv('RECENCY_HALF_LIFE', '0')) or None
+
+# (normalized question, collection version, window) -> /response body; ANSWER_CACHE_SIZE=0 disables
+answer_cache = LRUCache(
+    maxsize=int(os.getenv('ANSWER_CACHE_SIZE', '128')),
+    ttl=float(os.getenv('ANSWER_CACHE_TTL', '0')) or None
 )
 
-@app.route("/helloworld")
+# Where uploaded captures are written and /response reads them from
+# Created by create_app(); everything that writes there creates the subdirectories it needs
+CAPTURE_DIR = Path(os.getenv('CAPTURE_DIR', os.path.join("Raspberry-Pi", "captures")))
+
+# Downscaled copies of each capture for the vision model and for clients, plus an in-memory base64 LRU
+variants = ImageVariants(
+    CAPTURE_DIR,
+    model_max_side=int(os.getenv('MODEL_IMAGE_MAX_SIDE', '768')),
+    model_quality=int(os.getenv('MODEL_IMAGE_QUALITY', '80')),
+    thumb_max_side=int(os.getenv('THUMB_MAX_SIDE', '256')),
+    thumb_quality=int(os.getenv('THUMB_QUALITY', '70')),
+    cache_bytes=int(os.getenv('IMAGE_CACHE_MB', '64')) * 1024 * 1024
+)
+# "low" makes the model use a single 512px tile: fewer tokens, less detail
+MODEL_IMAGE_DETAIL = os.getenv('MODEL_IMAGE_DETAIL', 'auto')
+
+# Per image, and per request body (the app's MAX_CONTENT_LENGTH, which only a batch should approach);
+# both also hold for chunked bodies that send no Content-Length
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', str(20 * 1024 * 1024)))
+MAX_REQUEST_BYTES = int(os.getenv('MAX_REQUEST_BYTES', str(64 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# /upload_batch limits: frames per request, and describe calls in flight per batch
+MAX_BATCH_FRAMES = int(os.getenv('MAX_BATCH_FRAMES', '100'))
+DESCRIBE_CONCURRENCY = int(os.getenv('DESCRIBE_CONCURRENCY', '4'))
+
+api = Blueprint('api', __name__)
+
+# Served while the warm-up is still running; everything else gets a 503 until the store is open
+WARMUP_EXEMPT = {'healthz', 'readyz', 'hello_world', 'metrics', 'get_image', 'job_status'}
+
+REQUESTS = REGISTRY.counter('retrospecs_http_requests_total', "HTTP requests by endpoint and status", ['endpoint', 'method', 'status'])
+REQUEST_SECONDS = REGISTRY.histogram(
+    'retrospecs_http_request_seconds', "Time to produce the response (to the first byte for streams)", ['endpoint'])
+
+
+def endpoint_name():
+    """The view function's name, without the blueprint prefix"""
+    return request.endpoint.rsplit('.', 1)[-1] if request.endpoint else None
+
+
+class UploadTooLarge(ValueError):
+    """An image over MAX_UPLOAD_BYTES"""
+
+
+@api.app_errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    # Raised by Werkzeug while reading a body over MAX_REQUEST_BYTES
+    return {
+        "error": "Request too large"
+    }, 413
+
+
+@api.before_app_request
+def start_request():
+    # Callers may pass their own id to correlate logs across services
+    g.request_id = (request.headers.get('X-Request-ID') or uuid.uuid4().hex)[:64]
+    g.request_id_token = request_id_var.set(g.request_id)
+    g.request_start = time.perf_counter()
+
+    endpoint = endpoint_name()
+    if warmup['status'] != 'ready' and endpoint is not None and endpoint not in WARMUP_EXEMPT:
+        return {
+            "error": "Server is starting" if warmup['status'] == 'starting' else "Server failed to start"
+        }, 503, {'Retry-After': '1'}
+
+
+@api.after_app_request
+def finish_request(response):
+    elapsed = time.perf_counter() - g.request_start
+    endpoint = endpoint_name() or 'unknown'
+    REQUESTS.inc(endpoint=endpoint, method=request.method, status=str(response.status_code))
+    REQUEST_SECONDS.observe(elapsed, endpoint=endpoint)
+    response.headers['X-Request-ID'] = g.request_id
+    log.info("method=%s path=%s status=%d duration_ms=%.1f", request.method, request.path, response.status_code, elapsed * 1000)
+    return response
+
+
+@api.teardown_app_request
+def end_request(exc):
+    token = g.pop('request_id_token', None)
+    if token is not None:
+        request_id_var.reset(token)
+
+
+@api.route("/helloworld")
 def hello_world():
     return 'hello, world'
 
-@app.route("/upload_image", methods=['POST'])
+
+@api.route("/healthz")
+def healthz():
+    """Liveness: the process is up and serving, whether or not the store is open yet"""
+    return {
+        "status": "ok"
+    }, 200
+
+
+@api.route("/readyz")
+def readyz():
+    """Readiness: 200 once the store is open, 503 while warming up or after a failed warm-up"""
+    body = dict(warmup, startup={phase: round(seconds, 3) for phase, seconds in startup.items() if seconds is not None})
+    return body, 200 if warmup['status'] == 'ready' else 503
+
+@api.route("/upload_image", methods=['POST'])
 def upload_image():
     
     try:
-        # Get JSON data from request
-        data = request.json
-
         json_data = request.get_json()
         
         # Extract filename and base64 image
-        filename = json_data['filename']
+        filename = secure_filename(json_data['filename'])
         base64_image = json_data['base64']
-        timestamp = json_data['timestamp']
+        timestamp = check_timestamp(json_data['timestamp'])
+        household_id, camera_id = device_ids(json_data)
+        if not filename:
+            raise ValueError("Invalid filename")
+    except RequestEntityTooLarge:
+        raise
+    except Exception as e:
+        log.warning("Bad upload request: %s", e)
+        return {
+            "error": str(e)
+        }, 400
 
-        try:
+    try:
         # Test if it's valid base64
-            image_data = base64.b64decode(base64_image)
-            #image = Image.open(io.BytesIO(image_data))
-            #print(f"Image size: {image.size}")
-        except Exception as e:
-            print(f"Invalid base64: {str(e)}")
-        
-        desc = get_image_description(base64_image)
+        with STAGE_SECONDS.time(stage='upload.decode'):
+            image_data = base64.b64decode(base64_image, validate=True)
+    except Exception as e:
+        log.warning("Invalid base64: %s", e)
+        return {
+            "error": "Invalid base64: " + str(e)
+        }, 400
+    if len(image_data) > MAX_UPLOAD_BYTES:
+        return {
+            "error": "Image too large"
+        }, 413
+    try:
+        check_image(image_data)
+    except ValueError as e:
+        return {
+            "error": str(e)
+        }, 400
 
-        db.add_photo(desc, timestamp, filename)
+    try:
+        job_id = ingest_queue.submit({
+            'filename': capture_name(filename, household_id, camera_id),
+            'image': image_data,
+            'timestamp': timestamp,
+            'household_id': household_id,
+            'camera_id': camera_id,
+            'request_id': g.request_id
+        })
+    except QueueFull as e:
+        return {
+            "error": str(e)
+        }, 503, {'Retry-After': '5'}
+
+    return {
+        "message": "Image accepted",
+        "job_id": job_id
+    }, 202
 
+
+@api.route("/upload_image_raw", methods=['POST'])
+def upload_image_raw():
+    """
+    Binary upload: either a raw image/jpeg body with X-Filename / X-Timestamp headers,
+    or multipart/form-data with an 'image' file and filename / timestamp fields.
+    The camera is identified by X-Household-ID / X-Camera-ID headers or household_id / camera_id fields.
+    The image is streamed straight to CAPTURE_DIR.
+    """
+    if request.content_length is not None and request.content_length > MAX_UPLOAD_BYTES:
         return {
-            "message": "Image received successfully",
-        }, 200
-       
+            "error": "Image too large"
+        }, 413
+
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('image')
+        filename = request.form.get('filename') or (upload.filename if upload else None)
+        timestamp = request.form.get('timestamp')
+        ids = request.form
+    else:
+        upload = None
+        filename = request.headers.get('X-Filename')
+        timestamp = request.headers.get('X-Timestamp')
+        ids = {'household_id': request.headers.get('X-Household-ID'), 'camera_id': request.headers.get('X-Camera-ID')}
+
+    filename = secure_filename(filename or '')
+    if not filename or not timestamp or (request.mimetype == 'multipart/form-data' and upload is None):
+        return {
+            "error": "filename, timestamp and image are required"
+        }, 400
+
+    try:
+        check_timestamp(timestamp)
+        household_id, camera_id = device_ids(ids)
+        filename = capture_name(filename, household_id, camera_id)
+        with STAGE_SECONDS.time(stage='upload.save'):
+            path = save_capture(filename, upload)
+    except (UploadTooLarge, RequestEntityTooLarge):
+        return {
+            "error": "Image too large"
+        }, 413
     except Exception as e:
-        print(str(e))
+        log.warning("Rejected upload %s: %s", filename, e)
         return {
             "error": str(e)
         }, 400
 
+    try:
+        job_id = ingest_queue.submit({
+            'filename': filename,
+            'path': str(path),
+            'timestamp': timestamp,
+            'household_id': household_id,
+            'camera_id': camera_id,
+            'request_id': g.request_id
+        })
+    except QueueFull as e:
+        return {
+            "error": str(e)
+        }, 503, {'Retry-After': '5'}
 
-def get_image_description(base64_string):
+    return {
+        "message": "Image accepted",
+        "job_id": job_id
+    }, 202
 
-    prompt = """I'm looking at an image. Please provide a very detailed description in 3-4 sentences that captures:
-        1. The main subject or subjects
-        2. Important visual details and context
-        3. Any text that might be visible
-        4. The overall setting or environment
-        
-        Make the description detailed enough that someone could recognize this specific scene or object if they encountered it."""
-    
 
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": prompt,
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url":  f"data:image/jpeg;base64,{base64_string}"
-                        },
-                    },
-                ],
-            }
-        ]
-    )
+def device_ids(fields):
+    """
+    (household_id, camera_id) from request fields; either may be None (the default household / no camera)
+    Raises ValueError for malformed ids
+    """
+    household_id = check_device_id(fields.get('household_id') or None, 'household_id')
+    camera_id = check_device_id(fields.get('camera_id') or None, 'camera_id')
+    return household_id, camera_id
 
-    return response.choices[0].message.content
 
+def check_timestamp(timestamp):
+    """
+    Refuse a timestamp the store could not parse, before the upload is queued and the model is called
+    Raises ValueError; returns the timestamp unchanged
+    """
+    if timestamp is None or timestamp == '':
+        raise ValueError("timestamp is required")
+    try:
+        epoch = to_epoch(timestamp)
+    except (TypeError, ValueError, OverflowError):
+        epoch = None
+    if epoch is None or not math.isfinite(epoch):
+        raise ValueError(f"Invalid timestamp {timestamp!r}: use YYYYmmdd_HHMMSS, epoch seconds or ISO-8601")
+    return timestamp
 
-@app.route("/response", methods=['POST'])
-def process_query():
-    data = request.get_json()
 
-    query = data['query']
+# Leading bytes of the formats image_variants and the vision model accept
+IMAGE_SIGNATURES = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n')
+
+
+def check_image(data):
+    """Refuse a body that is not a JPEG or PNG, judged by its first bytes; raises ValueError"""
+    if not data.startswith(IMAGE_SIGNATURES):
+        raise ValueError("Not a JPEG or PNG image")
+
+
+def capture_name(filename, household_id=None, camera_id=None):
+    """
+    Where a capture is stored, relative to CAPTURE_DIR: directly in it for uploads without ids,
+    otherwise under households/<household>/<camera>/ so cameras naming files the same way never collide
+    """
+    if not household_id and not camera_id:
+        return filename
+    return f"households/{household_id or DEFAULT_HOUSEHOLD}/{camera_id or '_'}/{filename}"
+
 
+def save_capture(filename, upload=None):
+    """
+    Write an uploaded image to CAPTURE_DIR in chunks, via a .part file so readers never see half an image
+    filename: path relative to CAPTURE_DIR (see capture_name)
+    upload: a multipart FileStorage, or None to stream the raw request body
+    Raises UploadTooLarge past MAX_UPLOAD_BYTES, however the body is sent, and ValueError unless it is an image
+    """
+    path = CAPTURE_DIR / filename
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.part')
     try:
-       results = db.query_photos(query)[0]
-    except Exception as e:
-        print(str(e))
+        if upload is not None:
+            upload.save(tmp_path, buffer_size=UPLOAD_CHUNK_SIZE)
+        else:
+            with open(tmp_path, 'wb') as f:
+                written = 0
+                while True:
+                    chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    written += len(chunk)
+                    if written > MAX_UPLOAD_BYTES:
+                        raise UploadTooLarge("Image too large")
+                    f.write(chunk)
+
+        size = tmp_path.stat().st_size
+        if size == 0:
+            raise ValueError("Empty image")
+        if size > MAX_UPLOAD_BYTES:
+            raise UploadTooLarge("Image too large")
+        with open(tmp_path, 'rb') as f:
+            check_image(f.read(16))
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    return path
+
+
+@api.route("/upload_batch", methods=['POST'])
+def upload_batch():
+    """
+    Upload many frames in one request, either as
+    JSON {"frames": [{"filename", "timestamp", "base64"}, ...]} or as multipart/form-data
+    with repeated 'images' files and matching repeated 'filename' / 'timestamp' fields.
+    Optional household_id / camera_id fields (top-level in JSON) identify the camera for the whole batch.
+    Valid frames are ingested as a single job; the response has a status per frame.
+    """
+    if request.content_length is not None and request.content_length > MAX_REQUEST_BYTES:
         return {
-            "errorMessage": "error occurred during db query",
+            "error": "Batch too large"
+        }, 413
+
+    if request.mimetype == 'multipart/form-data':
+        uploads = request.files.getlist('images')
+        filenames = request.form.getlist('filename')
+        timestamps = request.form.getlist('timestamp')
+        raw_frames = [
+            {'upload': upload, 'filename': filenames[i] if i < len(filenames) else upload.filename,
+             'timestamp': timestamps[i] if i < len(timestamps) else None}
+            for i, upload in enumerate(uploads)
+        ]
+        ids = request.form
+    else:
+        json_data = request.get_json(silent=True)
+        if json_data is None:
+            json_data = {}
+        if not isinstance(json_data, dict) or not isinstance(json_data.get('frames') or [], list):
+            return {
+                "error": 'Expected a JSON object {"frames": [...]}'
+            }, 400
+        raw_frames = json_data.get('frames') or []
+        ids = json_data
+
+    try:
+        household_id, camera_id = device_ids(ids)
+    except ValueError as e:
+        return {
+            "error": str(e)
         }, 400
 
-    filename = results['filename']
+    if not raw_frames:
+        return {
+            "error": "No frames in request"
+        }, 400
+    if len(raw_frames) > MAX_BATCH_FRAMES:
+        return {
+            "error": f"At most {MAX_BATCH_FRAMES} frames per batch"
+        }, 413
 
-    file_path = os.path.join("Raspberry-Pi", "captures", filename)
+    frames, statuses = [], []
+    for raw in raw_frames:
+        if not isinstance(raw, dict):
+            statuses.append({"filename": None, "timestamp": None, "status": 'invalid', "error": "Frame must be an object"})
+            continue
+        filename = raw.get('filename')
+        filename = secure_filename(filename) if isinstance(filename, str) else ''
+        timestamp = raw.get('timestamp')
+        status = {"filename": filename, "timestamp": timestamp}
+        try:
+            if not filename:
+                raise ValueError("filename is required")
+            check_timestamp(timestamp)
+            frame = {'filename': capture_name(filename, household_id, camera_id), 'timestamp': timestamp,
+                     'household_id': household_id, 'camera_id': camera_id}
+            if 'upload' in raw:
+                frame['path'] = str(save_capture(frame['filename'], raw['upload']))
+            else:
+                frame['image'] = base64.b64decode(raw['base64'], validate=True)
+                if len(frame['image']) > MAX_UPLOAD_BYTES:
+                    raise UploadTooLarge("Image too large")
+                check_image(frame['image'])
+            frames.append(frame)
+            status['status'] = 'accepted'
+        except Exception as e:
+            status['status'] = 'invalid'
+            status['error'] = str(e)
+        statuses.append(status)
 
-    with open(file_path, 'rb') as f:
-        image_bytes = f.read()
-        base64_image = base64.b64encode(image_bytes).decode('utf-8')
+    if not frames:
+        return {
+            "error": "No valid frames",
+            "frames": statuses
+        }, 400
 
-    timestamp = results['timestamp']
+    try:
+        job_id = ingest_queue.submit({'frames': frames, 'request_id': g.request_id})
+    except QueueFull as e:
+        return {
+            "error": str(e)
+        }, 503, {'Retry-After': '5'}
 
-    prompt = "Respond to this question based on the following image and its description: " + str(results['description']) + " Question: " + query
+    return {
+        "message": f"{len(frames)} of {len(statuses)} images accepted",
+        "job_id": job_id,
+        "frames": statuses
+    }, 202
+
+
+@api.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = ingest_queue.status(job_id)
+    if job is None:
+        return {
+            "error": "Unknown job id"
+        }, 404
+
+    return job, 200
+
+
+def ingest_job(job):
+    """Ingest queue handler: batch jobs come from /upload_batch, single ones from the other upload routes"""
+    # The worker thread takes on the id of the request that queued the job, so its log lines
+    # (including the queue's own retry messages once this returns) can be traced back to the upload
+    request_id_var.set(job.get('request_id', '-'))
+    if 'frames' in job:
+        return ingest_batch(job['frames'])
+    return ingest_photo(job)
+
+
+def image_hash_for(image, filename):
+    """Perceptual hash for dedupe, or None if dedupe is off or the image can't be decoded"""
+    if DEDUPE_THRESHOLD < 0:
+        return None
+    try:
+        return dhash(image)
+    except Exception as e:
+        log.warning("Could not hash %s: %s", filename, e)
+        return None
+
+
+@contextmanager
+def timed(timings, path, stage):
+    """Add the seconds spent in the block to timings[stage], and record them as the "<path>.<stage>" stage metric"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        timings[stage] = timings.get(stage, 0.0) + seconds
+        STAGE_SECONDS.observe(seconds, stage=f"{path}.{stage}")
+
+
+def rounded(timings):
+    return {stage: round(seconds, 4) for stage, seconds in timings.items()}
 
+
+def model_image(filename, image):
+    """Save the capture and its variants; returns base64 of the model-ready image (the original if that fails)"""
     try:
+        variants.ingest(filename, image)
+        return variants.base64(filename, 'model')
+    except Exception as e:
+        log.warning("Could not build variants for %s: %s", filename, e)
+        return base64.b64encode(image).decode('utf-8')
+
+
+def ingest_photo(job):
+    """
+    Worker-side half of the upload endpoints: describe the image, embed and store it
+    The result carries the seconds spent in each stage
+    """
+    timings = {}
+    with timed(timings, 'ingest', 'variants'):
+        image = job['image'] if 'image' in job else Path(job['path']).read_bytes()
+        model_base64 = model_image(job['filename'], image)
+
+    household_id, camera_id = job.get('household_id'), job.get('camera_id')
+    with timed(timings, 'ingest', 'hash'):
+        image_hash = image_hash_for(image, job['filename'])
+        # Near-duplicate of a frame stored for this household: reuse its description and embedding
+        dedupe_index = dedupe_for(household_id)
+        duplicate_of = dedupe_index.find(image_hash) if image_hash is not None else None
+
+    if duplicate_of:
+        try:
+            with timed(timings, 'ingest', 'store'):
+                db.add_duplicate(duplicate_of, job['timestamp'], job['filename'], dhash=image_hash,
+                                 household_id=household_id, camera_id=camera_id)
+            return {
+                "filename": job['filename'],
+                "timestamp": job['timestamp'],
+                "duplicate_of": duplicate_of,
+                "timings": rounded(timings)
+            }
+        except KeyError:
+            # Merged away by compaction since the index was loaded: store the frame as a new photo
+            log.info("Duplicate source %s is gone, storing %s as new", duplicate_of, job['filename'])
+
+    # Kept on the job, so a retry after a failed store does not pay for the description again
+    if 'description' not in job:
+        with timed(timings, 'ingest', 'describe'):
+            job['description'] = get_image_description(model_base64)
+    desc = job['description']
+
+    with timed(timings, 'ingest', 'store'):
+        id_ = db.add_photo(desc, job['timestamp'], job['filename'], dhash=image_hash,
+                           household_id=household_id, camera_id=camera_id)
+    if image_hash is not None:
+        dedupe_index.add(image_hash, id_)
+
+    return {
+        "filename": job['filename'],
+        "timestamp": job['timestamp'],
+        "timings": rounded(timings)
+    }
+
+
+def ingest_batch(frames):
+    """
+    Ingest a batch of frames from one camera: dedupe, describe the rest concurrently,
+    then embed and store them with a single add_photos call
+    A frame that fails only marks itself failed: if the single call fails, frames are stored one by one
+    Returns a status per frame, and the seconds spent in each stage for the whole batch
+    """
+    timings = {}
+    household_id, camera_id = frames[0].get('household_id'), frames[0].get('camera_id')
+    dedupe_index = dedupe_for(household_id)
+    results = [{"filename": f['filename'], "timestamp": f['timestamp']} for f in frames]
+    new = []        # (index, frame, model_base64, image_hash)
+    in_batch = []   # (index into results, image_hash) of new frames, for duplicates within the batch
+
+    for i, frame in enumerate(frames):
+        try:
+            image = frame['image'] if 'image' in frame else Path(frame['path']).read_bytes()
+        except Exception as e:
+            results[i].update(status='failed', error=str(e))
+            continue
+
+        with timed(timings, 'ingest_batch', 'variants'):
+            model_base64 = model_image(frame['filename'], image)
+
+        with timed(timings, 'ingest_batch', 'hash'):
+            image_hash = image_hash_for(image, frame['filename'])
+            duplicate_of = dedupe_index.find(image_hash) if image_hash is not None else None
+        if image_hash is not None:
+            if duplicate_of:
+                try:
+                    db.add_duplicate(duplicate_of, frame['timestamp'], frame['filename'], dhash=image_hash,
+                                     household_id=household_id, camera_id=camera_id)
+                    results[i].update(status='duplicate', duplicate_of=duplicate_of)
+                    continue
+                except KeyError:
+                    log.info("Duplicate source %s is gone, storing %s as new", duplicate_of, frame['filename'])
+                except Exception as e:
+                    results[i].update(status='failed', error=str(e))
+                    continue
+
+            earlier = next((j for j, h in in_batch if hamming(h, image_hash) <= dedupe_index.threshold), None)
+            if earlier is not None:
+                results[i].update(status='duplicate', duplicate_of_frame=earlier)
+                continue
+            in_batch.append((i, image_hash))
+
+        new.append((i, frame, model_base64, image_hash))
+
+    def describe(item):
+        # Kept on the frame, so a retried job does not pay for the description again
+        frame = item[1]
+        if 'description' not in frame:
+            try:
+                frame['description'] = get_image_description(item[2])
+            except Exception as e:
+                return e
+        return frame['description']
+
+    with timed(timings, 'ingest_batch', 'describe'), ThreadPoolExecutor(max_workers=DESCRIBE_CONCURRENCY) as pool:
+        descriptions = list(pool.map(describe, new))
+
+    described = []
+    for item, desc in zip(new, descriptions):
+        if isinstance(desc, Exception):
+            results[item[0]].update(status='failed', error=str(desc))
+        else:
+            described.append((item, desc))
+
+    photos = [
+        {'description': desc, 'timestamp': frame['timestamp'], 'filename': frame['filename'], 'dhash': image_hash,
+         'household_id': household_id, 'camera_id': camera_id}
+        for (_, frame, _, image_hash), desc in described
+    ]
+    with timed(timings, 'ingest_batch', 'store'):
+        try:
+            ids = db.add_photos(photos)
+        except Exception as e:
+            log.warning("Storing %d frames at once failed (%s), storing them one by one", len(photos), e)
+            ids = []
+            for photo in photos:
+                try:
+                    ids.append(db.add_photos([photo])[0])
+                except Exception as e:
+                    ids.append(e)
+
+    stored = {}
+    for ((i, _, _, image_hash), _), id_ in zip(described, ids):
+        if isinstance(id_, Exception):
+            results[i].update(status='failed', error=str(id_))
+            continue
+        if image_hash is not None:
+            dedupe_index.add(image_hash, id_)
+        stored[i] = id_
+        results[i]['status'] = 'stored'
+
+    # Frames that duplicated an earlier frame of this batch reuse its stored row
+    for i, result in enumerate(results):
+        earlier = result.pop('duplicate_of_frame', None)
+        if earlier is None:
+            continue
+        if earlier not in stored:
+            result.update(status='failed', error="Duplicate of a frame that failed")
+            continue
+        try:
+            db.add_duplicate(stored[earlier], frames[i]['timestamp'], frames[i]['filename'],
+                             household_id=household_id, camera_id=camera_id)
+            result['duplicate_of'] = stored[earlier]
+        except Exception as e:
+            result.update(status='failed', error=str(e))
+
+    return {"frames": results, "timings": rounded(timings)}
+
+
+# Perceptual-hash index per household over its stored frames; DEDUPE_THRESHOLD=-1 disables
+DEDUPE_THRESHOLD = int(os.getenv('DEDUPE_THRESHOLD', '5'))
+dedupe_indexes = {}
+dedupe_lock = threading.Lock()
+
+
+def dedupe_for(household_id):
+    """The household's dedupe index, loaded from the store on first use; None when dedupe is off"""
+    if DEDUPE_THRESHOLD < 0:
+        return None
+    household_id = household_id or DEFAULT_HOUSEHOLD
+    with dedupe_lock:
+        index = dedupe_indexes.get(household_id)
+        if index is None:
+            index = dedupe_indexes[household_id] = DedupeIndex(DEDUPE_THRESHOLD).load(db.photo_hashes(household_id))
+        return index
+
+
+# Workers are started by create_app()
+ingest_queue = IngestQueue(
+    ingest_job,
+    workers=int(os.getenv('INGEST_WORKERS', '4')),
+    maxsize=int(os.getenv('INGEST_QUEUE_SIZE', '64')),
+    max_retries=int(os.getenv('INGEST_MAX_RETRIES', '3'))
+)
+
+
+def cache_counts(field):
+    caches = {
+        'answers': answer_cache,
+        'images': variants.cache
+    }
+    if db is not None:
+        caches.update(query_embeddings=db.query_cache, results=db.result_cache)
+    return {(name,): cache.stats()[field] for name, cache in caches.items()}
+
+
+# Read at scrape time, so they add nothing to the request path
+REGISTRY.gauge_callback('retrospecs_ingest_queue_depth', "Jobs waiting in the ingest queue", ingest_queue.depth)
+REGISTRY.gauge_callback('retrospecs_photos', "Rows across every photo shard", lambda: db.count() if db is not None else 0)
+REGISTRY.counter_callback('retrospecs_cache_hits_total', "Cache hits", lambda: cache_counts('hits'), ['cache'])
+REGISTRY.counter_callback('retrospecs_cache_misses_total', "Cache misses", lambda: cache_counts('misses'), ['cache'])
+REGISTRY.gauge_callback('retrospecs_cache_entries', "Entries held in each cache", lambda: cache_counts('size'), ['cache'])
+REGISTRY.gauge_callback(
+    'retrospecs_startup_seconds', "Seconds from server.py starting to load until the end of each startup phase",
+    lambda: {(phase,): seconds for phase, seconds in startup.items() if seconds is not None}, ['phase'])
+
+
+def get_image_description(base64_string):
+
+    prompt = """I'm looking at an image. Please provide a very detailed description in 3-4 sentences that captures:
+        1. The main subject or subjects
+        2. Important visual details and context
+        3. Any text that might be visible
+        4. The overall setting or environment
+        
+        Make the description detailed enough that someone could recognize this specific scene or object if they encountered it."""
+    
+
+    with model_call('describe'):
         response = client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
-             #   {
-             #       "role": "system",
-             #       "content": "Process the prompt with the following context (images with descriptions): " + str(results['description'])
-             #   },
                 {
                     "role": "user",
                     "content": [
@@ -145,26 +787,398 @@ def process_query():
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url":  f"data:image/jpeg;base64,{base64_image}"
+                                "url":  f"data:image/jpeg;base64,{base64_string}",
+                                "detail": MODEL_IMAGE_DETAIL
+                            },
                         },
-                    },
                     ],
                 }
             ]
         )
+    record_usage('describe', getattr(response, 'usage', None))
+
+    return response.choices[0].message.content
+
+
+def summarize_episode(descriptions):
+    """One description for a run of similar frames merged by compaction"""
+    prompt = ("These are descriptions of consecutive camera frames of the same scene, oldest first. "
+              "Write one detailed description in 3-4 sentences of the scene and of anything that changed "
+              "over the frames, keeping any visible text.\n\n" + "\n\n".join(descriptions))
+
+    with model_call('summarize'):
+        response = client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[{"role": "user", "content": [{"type": "text", "text": prompt}]}]
+        )
+    record_usage('summarize', getattr(response, 'usage', None))
+
+    return response.choices[0].message.content
+
+
+def reset_dedupe():
+    """Reload dedupe indexes on next use, after compaction deleted the rows they point to"""
+    with dedupe_lock:
+        dedupe_indexes.clear()
+
+
+# Merges old similar frames into episodes and keeps captures under CAPTURE_DISK_BUDGET_MB (see compaction.py)
+# COMPACTION_INTERVAL_HOURS=0 disables the background job; the budget needs CAPTURE_DIR set to a dedicated directory
+COMPACTION_INTERVAL_HOURS = float(os.getenv('COMPACTION_INTERVAL_HOURS', '0'))
+CAPTURE_DISK_BUDGET_MB = float(os.getenv('CAPTURE_DISK_BUDGET_MB', '0'))
+
+
+def warm_up(seed_demo=False):
+    """
+    Build the model client, open the store and start compaction, then seed the demo photos
+    The server is ready (see /readyz) as soon as the store is open; seeding needs the embeddings API,
+    so it runs after that and a failure is only logged
+    """
+    global client, db, compactor
+
+    try:
+        client = create_client()
+        db = VectorDB(
+            client=client,
+            persist_directory=os.getenv('CHROMA_PERSIST_DIR', 'chroma_data'),
+            storage=os.getenv('VECTOR_STORE', 'chroma'),
+            numpy_dtype=os.getenv('NUMPY_STORE_DTYPE', 'int8'),
+            batch_window=float(os.getenv('EMBED_BATCH_WINDOW', '0.05')),
+            query_cache_size=int(os.getenv('QUERY_CACHE_SIZE', '256')),
+            query_cache_ttl=float(os.getenv('QUERY_CACHE_TTL', '0')) or None,
+            result_cache_size=int(os.getenv('RESULT_CACHE_SIZE', '256'))
+        )
+        startup['store'] = time.perf_counter() - STARTED
+
+        compactor = Compactor(
+            db, variants,
+            checkpoint_path=os.getenv('COMPACTION_CHECKPOINT',
+                                      os.path.join(os.getenv('CHROMA_PERSIST_DIR', 'chroma_data'), 'compaction.json')),
+            similarity=float(os.getenv('COMPACTION_SIMILARITY', '0.85')),
+            max_gap=float(os.getenv('COMPACTION_MAX_GAP', '120')),
+            max_span=float(os.getenv('COMPACTION_MAX_SPAN', '3600')),
+            min_age=float(os.getenv('COMPACTION_MIN_AGE_HOURS', '24')) * 3600,
+            disk_budget=int(CAPTURE_DISK_BUDGET_MB * 1024 * 1024) or None,
+            summarize=summarize_episode if os.getenv('COMPACTION_SUMMARIZE', '0').lower() in ('1', 'true', 'yes') else None,
+            on_change=reset_dedupe
+        )
+        if COMPACTION_INTERVAL_HOURS > 0:
+            compactor.start(COMPACTION_INTERVAL_HOURS * 3600)
     except Exception as e:
-        print(str(e))
+        log.exception("Warm-up failed")
+        warmup.update(status='failed', error=str(e))
+        return
+
+    startup['ready'] = time.perf_counter() - STARTED
+    warmup['status'] = 'ready'
+    log.info("Ready in %.2fs (imports %.2fs, store %.2fs)", startup['ready'], startup['import'], startup['store'])
+
+    if seed_demo:
+        try:
+            db.demo_init()
+        except Exception as e:
+            log.warning("Could not seed the demo photos: %s", e)
+        startup['seed'] = time.perf_counter() - STARTED
+
+
+def create_app(seed_demo=False, background=True):
+    """
+    Create the capture directory, build the Flask app, start the ingest workers and warm up
+    seed_demo: add the demo photos once the store is open (what `python server.py` does)
+    background: warm up on a thread so the app serves /healthz and /readyz right away;
+        False warms up before returning (scripts and benchmarks that use the app in-process)
+    """
+    CAPTURE_DIR.mkdir(parents=True, exist_ok=True)
+
+    app = Flask(__name__)
+    app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
+    CORS(app)
+    app.register_blueprint(api)
+
+    ingest_queue.start()
+    if background:
+        threading.Thread(target=warm_up, args=(seed_demo,), name="warm-up", daemon=True).start()
+    else:
+        warm_up(seed_demo)
+
+    return app
+
+
+def time_window(data, query):
+    """
+    Time window for a /response query: explicit since/until fields win,
+    otherwise "today"/"yesterday" style wording narrows the search
+    Returns (since, until, explicit); raises ValueError for an explicit bound the store could not parse
+    """
+    if data.get('since') is not None or data.get('until') is not None:
+        for field in ('since', 'until'):
+            if data.get(field) is not None:
+                try:
+                    check_timestamp(data[field])
+                except ValueError as e:
+                    raise ValueError(f"{field}: {e}") from None
+        return data.get('since'), data.get('until'), True
+
+    text = normalize_query(query)
+    midnight = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    if 'yesterday' in text:
+        return (midnight - datetime.timedelta(days=1)).timestamp(), midnight.timestamp(), False
+    if any(word in text for word in ('today', 'this morning', 'this afternoon', 'tonight')):
+        return midnight.timestamp(), None, False
+
+    return None, None, False
+
+
+def answer_messages(results, query, base64_image):
+    prompt = "Respond to this question based on the following image and its description: " + str(results['description']) + " Question: " + query
+
+    return [
+     #   {
+     #       "role": "system",
+     #       "content": "Process the prompt with the following context (images with descriptions): " + str(results['description'])
+     #   },
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": prompt,
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url":  f"data:image/jpeg;base64,{base64_image}",
+                        "detail": MODEL_IMAGE_DETAIL
+                },
+            },
+            ],
+        }
+    ]
+
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@api.route("/response", methods=['POST'])
+def process_query():
+    """
+    Answer a question about a stored memory
+    Set "stream": true (or send Accept: text/event-stream) to get Server-Sent Events:
+    a "match" event with the timestamp and image URL as soon as retrieval finishes,
+    then "token" events as the answer is generated, then "done"
+    "household_id" picks whose memories are searched (every camera of that household, concurrently);
+    "camera_ids" (or "camera_id") narrows the search to some of its cameras
+    Stage durations are reported in a Server-Timing header
+    """
+    data = request.get_json()
+
+    query = data['query']
+    stream = bool(data.get('stream')) or request.accept_mimetypes.best == 'text/event-stream'
+    include_image = data.get('include_image', True)
+
+    try:
+        household_id = check_device_id(data.get('household_id') or None, 'household_id') or DEFAULT_HOUSEHOLD
+        camera_ids = data.get('camera_ids') or data.get('camera_id') or None
+        if isinstance(camera_ids, str):
+            camera_ids = [camera_ids]
+        if camera_ids is not None:
+            camera_ids = tuple(sorted(check_device_id(c, 'camera_id') for c in camera_ids))
+    except (TypeError, ValueError) as e:
+        return {
+            "error": str(e)
+        }, 400
+    scope = {'household_id': household_id, 'camera_ids': camera_ids}
+
+    try:
+        since, until, explicit = time_window(data, query)
+    except ValueError as e:
+        return {
+            "error": str(e)
+        }, 400
+
+    answer_key = (normalize_query(query), db.version, since, until, household_id, camera_ids)
+    cached = answer_cache.get(answer_key)
+    if cached is not None and not stream:
+        body = cached if include_image else {k: v for k, v in cached.items() if k != 'image'}
+        return body, 200, {'Server-Timing': 'cache;desc="hit"'}
+
+    timings = {}
+    try:
+        with timed(timings, 'response', 'retrieve'):
+            matches = db.query_photos(query, since=since, until=until, recency_half_life=RECENCY_HALF_LIFE, **scope)
+            if not matches and not explicit and (since or until):
+                # Window was only guessed from the wording; fall back to searching everything
+                matches = db.query_photos(query, recency_half_life=RECENCY_HALF_LIFE, **scope)
+    except Exception as e:
+        log.exception("Query failed: %s", e)
+        return {
+            "errorMessage": "error occurred during db query",
+        }, 400
+
+    if not matches:
+        return {
+            "errorMessage": "No memories stored yet",
+        }, 404
+    results = matches[0]
+
+    filename = results['filename']
+    timestamp = results['timestamp']
+    image_url = url_for('api.get_image', filename=filename)
+
+    if stream:
+        return Response(
+            stream_with_context(stream_answer(results, query, answer_key, cached)),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no', 'Server-Timing': server_timing(timings)}
+        )
+
+    # Both come from the in-memory variant cache when the capture is hot
+    with timed(timings, 'response', 'image'):
+        base64_image = variants.base64(filename)
+        model_base64 = variants.base64(filename, 'model')
+
+    try:
+        with timed(timings, 'response', 'model'), model_call('answer'):
+            response = client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=answer_messages(results, query, model_base64)
+            )
+        record_usage('answer', getattr(response, 'usage', None))
+    except Exception as e:
+        log.warning("Answer failed: %s", e)
         return {
             "errorMessage": "OpenAI error: " + str(e)
         }, 400
     
-    return {
+    answer = {
         "image": base64_image,
+        "image_url": image_url,
         "timestamp": timestamp,
         "content": response.choices[0].message.content
-    }, 200
+    }
+    answer_cache.set(answer_key, answer)
+
+    if not include_image:
+        answer = {k: v for k, v in answer.items() if k != 'image'}
+
+    return answer, 200, {'Server-Timing': server_timing(timings)}
+
+
+def server_timing(timings):
+    """Server-Timing header value (durations in ms) for a dict of stage -> seconds"""
+    return ', '.join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+
+def stream_answer(results, query, answer_key, cached):
+    """SSE generator for a streamed /response"""
+    filename = results['filename']
+    yield sse("match", {
+        "timestamp": results['timestamp'],
+        "filename": filename,
+        "image_url": url_for('api.get_image', filename=filename)
+    })
+
+    if cached is not None:
+        yield sse("token", {"content": cached['content']})
+        yield sse("done", {"content": cached['content']})
+        return
+
+    try:
+        with model_call('answer_stream'):
+            response = client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=answer_messages(results, query, variants.base64(filename, 'model')),
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+
+            parts = []
+            for chunk in response:
+                if not chunk.choices:
+                    # The final chunk carries the token usage
+                    record_usage('answer_stream', getattr(chunk, 'usage', None))
+                    continue
+                token = chunk.choices[0].delta.content
+                if token:
+                    parts.append(token)
+                    yield sse("token", {"content": token})
+    except Exception as e:
+        log.warning("Streamed answer failed: %s", e)
+        yield sse("error", {"errorMessage": "OpenAI error: " + str(e)})
+        return
+
+    content = ''.join(parts)
+    answer_cache.set(answer_key, {
+        "image": variants.base64(filename),
+        "image_url": url_for('api.get_image', filename=filename),
+        "timestamp": results['timestamp'],
+        "content": content
+    })
+    yield sse("done", {"content": content})
+
+
+@api.route("/images/<path:filename>")
+def get_image(filename):
+    """
+    Serve a capture by name, with ETag / Last-Modified revalidation and Range requests
+    ?variant=thumb or ?variant=model serves a derived copy instead of the original
+    """
+    variant = request.args.get('variant', 'original')
+
+    # Captures from identified cameras live in subdirectories; refuse anything that escapes CAPTURE_DIR
+    if safe_join(str(CAPTURE_DIR), filename) is None:
+        return {
+            "error": "Unknown image"
+        }, 404
+
+    if variant == 'original':
+        # Originals evicted by compaction are served as their model-size copy
+        path = variants.fallback(filename)
+        return send_from_directory(path.parent.resolve(), path.name, conditional=True, etag=True, max_age=3600)
+
+    try:
+        path = variants.path(filename, variant)
+        if not path.exists():
+            variants.read(filename, variant)
+    except ValueError as e:
+        return {
+            "error": str(e)
+        }, 400
+    except FileNotFoundError:
+        return {
+            "error": "Unknown image"
+        }, 404
+
+    return send_from_directory(path.parent.resolve(), path.name, conditional=True, etag=True, max_age=3600)
+
+
+@api.route("/metrics")
+def metrics():
+    """Prometheus metrics; 404 when METRICS_ENABLED=0"""
+    if not REGISTRY.enabled:
+        return {
+            "error": "Metrics are disabled"
+        }, 404
+
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+@api.route("/compaction")
+def compaction_report():
+    """Report of the last compaction run (rows and bytes reclaimed), and its per-shard progress"""
+    return compactor.load_checkpoint(), 200
+
+
+@api.route("/cache_stats")
+def cache_stats():
+    stats = db.cache_stats()
+    stats['answers'] = answer_cache.stats()
+    return stats, 200
+
+
+startup['import'] = time.perf_counter() - STARTED
 
 
 if __name__ == "__main__":
-    db.demo_init()
-    app.run(host='0.0.0.0', port=4000)
\ No newline at end of file
+    create_app(seed_demo=True).run(host='0.0.0.0', port=int(os.getenv('PORT', '4000')))
\ No newline at end of file
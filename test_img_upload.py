@@ -1,22 +1,30 @@
 import requests
 import base64
+import time
+
+SERVER = 'http://localhost:4000'
 
 # Read image file and convert to base64
-with open('chicago_picture.jpeg', 'rb') as f:
+with open('Raspberry-Pi/captures/keys.jpg', 'rb') as f:
     image_bytes = f.read()
     base64_image = base64.b64encode(image_bytes).decode('utf-8')
 
 # Prepare data
 data = {
-    'filename': 'chicago_picture.jpg',
-    'image': base64_image
+    'filename': 'test_upload_keys.jpg',
+    'base64': base64_image,
+    'timestamp': time.strftime("%Y%m%d_%H%M%S")
 }
 
-# Send POST request
-response = requests.post(
-    'http://localhost:4000/upload_image',
-    data=data,
-    headers={'Content-Type': 'application/json'}
-)
+# Send POST request; the image is ingested in the background
+response = requests.post(SERVER + '/upload_image', json=data)
+print(response.status_code, response.json())
 
-print(response.json())
\ No newline at end of file
+# Wait for the ingest job to finish
+job_id = response.json().get('job_id')
+while job_id:
+    job = requests.get(f"{SERVER}/jobs/{job_id}").json()
+    if job['status'] in ('done', 'failed'):
+        print(job)
+        break
+    time.sleep(0.5)
@@ -0,0 +1,142 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import numpy_store
+from numpy_store import NumpyClient, NumpyCollection
+
+DIM = 16
+
+
+@pytest.fixture(params=['int8', 'float16'])
+def dtype(request):
+    return request.param
+
+
+def vectors(n, seed=0):
+    v = np.random.default_rng(seed).standard_normal((n, DIM)).astype(np.float32)
+    return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+
+def fill(collection, n, seed=0):
+    ids = [f"id{i}" for i in range(n)]
+    collection.upsert(
+        ids=ids,
+        embeddings=vectors(n, seed),
+        documents=[f"doc {i}" for i in range(n)],
+        metadatas=[{'ts': float(i), 'camera_id': f"cam{i % 2}"} for i in range(n)]
+    )
+    return ids
+
+
+def reopen(collection):
+    return NumpyCollection(collection.path, collection.name)
+
+
+def test_upsert_get_and_query(tmp_path, dtype):
+    collection = NumpyClient(tmp_path, dtype=dtype).get_or_create_collection("photos")
+    fill(collection, 20)
+
+    assert collection.count() == 20
+    got = collection.get(ids=['id3'], include=['documents', 'metadatas', 'embeddings'])
+    assert got['documents'] == ['doc 3']
+    assert got['metadatas'] == [{'ts': 3.0, 'camera_id': 'cam1'}]
+    np.testing.assert_allclose(got['embeddings'][0], vectors(20)[3], atol=0.02)
+
+    result = collection.query(query_embeddings=[vectors(20)[7]], n_results=3)
+    assert result['ids'][0][0] == 'id7'
+    assert result['distances'][0][0] == pytest.approx(0.0, abs=0.01)
+
+
+def test_upsert_overwrites_in_place(tmp_path, dtype):
+    collection = NumpyClient(tmp_path, dtype=dtype).get_or_create_collection("photos")
+    fill(collection, 5)
+    collection.upsert(ids=['id2'], embeddings=vectors(1, seed=1), documents=['new'], metadatas=[{'ts': 100.0}])
+
+    for c in (collection, reopen(collection)):
+        assert c.count() == 5
+        assert c.get(ids=['id2'])['documents'] == ['new']
+        assert c.query(query_embeddings=vectors(1, seed=1), n_results=1)['ids'] == [['id2']]
+
+
+def test_where_filters(tmp_path):
+    collection = NumpyClient(tmp_path).get_or_create_collection("photos")
+    fill(collection, 10)
+
+    window = collection.get(where={'$and': [{'ts': {'$gte': 2.0}}, {'ts': {'$lt': 5.0}}]})
+    assert window['ids'] == ['id2', 'id3', 'id4']
+    assert len(collection.get(where={'camera_id': {'$in': ['cam0']}})['ids']) == 5
+    assert collection.get(where={'$or': [{'ts': 0.0}, {'ts': 9.0}]})['ids'] == ['id0', 'id9']
+
+
+def test_delete_survives_reload(tmp_path, dtype):
+    collection = NumpyClient(tmp_path, dtype=dtype).get_or_create_collection("photos")
+    fill(collection, 10)
+    collection.delete(ids=['id1', 'id4'])
+    collection.delete(where={'ts': {'$gte': 8.0}})
+
+    reloaded = reopen(collection)
+    assert reloaded.dtype == np.dtype(dtype)
+    assert reloaded.count() == 6
+    assert reloaded.get(ids=['id1', 'id4', 'id8', 'id9'])['ids'] == []
+    assert reloaded.get(ids=['id5'])['documents'] == ['doc 5']
+    assert 'id1' not in reloaded.query(query_embeddings=[vectors(10)[1]], n_results=6)['ids'][0]
+
+
+def test_torn_log_write_is_dropped(tmp_path):
+    collection = NumpyClient(tmp_path).get_or_create_collection("photos")
+    fill(collection, 3)
+    with open(collection.path / "meta.jsonl", 'ab') as f:
+        f.write(b'{"op": "put", "row": 3, "id": "half')
+
+    reloaded = reopen(collection)
+    assert reloaded.count() == 3
+    assert (collection.path / "meta.jsonl").read_bytes().endswith(b'\n')
+    # Appends after the repair land on a line of their own
+    reloaded.upsert(ids=['id3'], embeddings=vectors(1, seed=3), documents=['doc 3'], metadatas=[{'ts': 3.0}])
+    assert reopen(reloaded).get(ids=['id3'])['documents'] == ['doc 3']
+
+
+def test_vacuum_reclaims_deleted_rows(tmp_path, dtype):
+    collection = NumpyClient(tmp_path, dtype=dtype).get_or_create_collection("photos")
+    fill(collection, 2000)
+    collection.delete(ids=[f"id{i}" for i in range(0, 2000, 2)])
+
+    assert collection.vacuum() > 0
+    for c in (collection, reopen(collection)):
+        assert c.count() == 1000
+        assert c.get(ids=['id7'])['documents'] == ['doc 7']
+        assert c.query(query_embeddings=[vectors(2000)[7]], n_results=1)['ids'] == [['id7']]
+        lines = (c.path / "meta.jsonl").read_text().splitlines()
+        assert len(lines) == 1000 and all(json.loads(line)['op'] == 'put' for line in lines)
+
+
+@pytest.mark.parametrize('failing_replace', [1, 2])
+def test_interrupted_vacuum_keeps_a_complete_copy(tmp_path, monkeypatch, failing_replace):
+    """A crash before (1) or between (2) the two directory renames leaves the data readable on reopen"""
+    collection = NumpyClient(tmp_path).get_or_create_collection("photos")
+    fill(collection, 10)
+    collection.delete(ids=['id0'])
+
+    calls = []
+    real_replace = os.replace
+
+    def crashing_replace(src, dst):
+        calls.append(src)
+        if len(calls) == failing_replace:
+            raise OSError("simulated crash")
+        return real_replace(src, dst)
+
+    monkeypatch.setattr(numpy_store.os, 'replace', crashing_replace)
+    with pytest.raises(OSError):
+        collection.vacuum()
+    monkeypatch.setattr(numpy_store.os, 'replace', real_replace)
+
+    reloaded = NumpyClient(tmp_path).get_or_create_collection("photos")
+    assert reloaded.count() == 9
+    assert reloaded.get(ids=['id5'])['documents'] == ['doc 5']
+    assert not numpy_store._sibling(collection.path, 'vacuum').exists()
+    assert not numpy_store._sibling(collection.path, 'old').exists()
+    assert [c.name for c in NumpyClient(tmp_path).list_collections()] == ['photos']
@@ -1,26 +1,207 @@
 import base64
+import hashlib
+import logging
 import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import List, Dict
-import chromadb
-from chromadb.config import Settings
-from openai import OpenAI
 import json
 from dotenv import load_dotenv
+from model_client import create_client
+from batching import MicroBatcher
+from cache import LRUCache, normalize_query
+from numpy_store import NumpyClient
+from embeddings import OPENAI_EMBEDDING_DIM, OPENAI_EMBEDDING_MODEL, create_embedder
+from metrics import STAGE_SECONDS
+
+log = logging.getLogger(__name__)
 
 load_dotenv()
 
+COLLECTION_NAME = "photo_memories"
+# Photos uploaded without a household id belong here; its unnamed camera keeps the original collection
+DEFAULT_HOUSEHOLD = "default"
+# Household and camera ids: also used as directory names for captures
+DEVICE_ID_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$")
+# Threads searching shards in parallel for one query
+SHARD_QUERY_WORKERS = 8
+# Rows per collection.upsert when restoring a snapshot
+RESTORE_CHUNK_SIZE = 1000
+
+
+# With recency reranking, fetch this many times k candidates before reranking
+RECENCY_CANDIDATES = 4
+
+
+def to_epoch(timestamp) -> float:
+    """
+    Normalize the timestamp formats we receive to epoch seconds (local time)
+    Accepts datetimes, epoch numbers, the camera's "YYYYmmdd_HHMMSS" strings,
+    the seed data's YYYYmmddHHMMSS ints and ISO-8601 strings
+    """
+    if isinstance(timestamp, datetime):
+        return timestamp.timestamp()
+
+    text = str(timestamp).strip()
+    digits = text.replace('_', '')
+    if len(digits) == 14 and digits.isdigit():
+        return datetime.strptime(digits, "%Y%m%d%H%M%S").timestamp()
+
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.fromisoformat(text).timestamp()
+
+
+def photo_id(description, timestamp, filename, household_id=None, camera_id=None):
+    """
+    Content-hash id, so re-adding an identical photo is a no-op
+    Household and camera are part of the hash, so identical frames from two cameras never collide;
+    photos without either keep the ids they had before sharding
+    """
+    key = f"{filename}|{timestamp}|{description}"
+    if (household_id or DEFAULT_HOUSEHOLD) != DEFAULT_HOUSEHOLD or camera_id:
+        key = f"{household_id or DEFAULT_HOUSEHOLD}|{camera_id or ''}|{key}"
+    digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    return f"photo_{digest[:32]}"
+
+
+def shard_name(household_id, camera_id=None):
+    """
+    Collection holding one camera's photos
+    Names are hashed because collection names are length- and charset-limited;
+    the ids themselves are kept in the collection metadata
+    """
+    if household_id == DEFAULT_HOUSEHOLD and not camera_id:
+        return COLLECTION_NAME
+    digest = hashlib.sha256(f"{household_id}/{camera_id or ''}".encode('utf-8')).hexdigest()
+    return f"{COLLECTION_NAME}.{digest[:16]}"
+
+
+def check_device_id(value, kind):
+    """Validate a household or camera id; None passes through"""
+    if value is not None and not DEVICE_ID_PATTERN.match(str(value)):
+        raise ValueError(f"Invalid {kind}: use 1-64 letters, digits, '-' or '_'")
+    return value
+
+
 class VectorDB:
-    def __init__(self):
-        self.client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+    def __init__(self, client=None, persist_directory=None, batch_window=None, max_batch=64,
+                 query_cache_size=256, query_cache_ttl=None, result_cache_size=256, embedder=None,
+                 storage="chroma", numpy_dtype="int8"):
+        """
+        client: model client (defaults to create_client())
+        embedder: EmbeddingProvider (defaults to create_embedder(), i.e. EMBEDDING_BACKEND)
+        storage: "chroma", or "numpy" for the in-process memory-mapped index in numpy_store.py
+        numpy_dtype: "int8" (default) or "float16" vector storage for new numpy collections; int8 scans
+            several times faster and halves the file, existing collections keep the dtype they were built with
+        persist_directory: if set, store the collection on disk there and reopen it on restart
+        batch_window: if set, concurrent add_photo calls arriving within this many seconds
+            are coalesced into a single add_photos call
+        query_cache_size / query_cache_ttl: LRU of normalized question -> embedding (0 disables)
+        result_cache_size: LRU of (query embedding, collection version) -> results (0 disables)
+
+        Photos are sharded into one collection per (household, camera); queries search every shard
+        of one household concurrently and merge the top k. Existing shards are reopened on start
+        """
+        self.client = client or create_client()
+        self.embedder = embedder or create_embedder(self.client)
+        self.batcher = MicroBatcher(self.add_photos, window=batch_window, max_batch=max_batch) if batch_window else None
+
+        self.query_cache = LRUCache(maxsize=query_cache_size, ttl=query_cache_ttl)
+        self.result_cache = LRUCache(maxsize=result_cache_size)
+        # Bumped on every insert so cached results never outlive the data they came from; under a lock,
+        # since ingest workers, the micro-batcher and compaction all insert, and a lost bump would keep
+        # serving results (and server.py's answers) cached before an insert
+        self.version = 0
+        self._version_lock = threading.Lock()
         
-        # Use in-memory ChromaDB client
-        self.chroma_client = chromadb.Client()
+        if storage == "numpy":
+            self.store_client = NumpyClient(path=persist_directory, dtype=numpy_dtype)
+        else:
+            # Imported here: chromadb takes over a second to import, and the numpy engine does not need it
+            import chromadb
+            if persist_directory:
+                self.store_client = chromadb.PersistentClient(path=persist_directory)
+            else:
+                # Use in-memory ChromaDB client
+                self.store_client = chromadb.Client()
         
-        # Create collection
-        self.collection = self.chroma_client.create_collection(
-            name="photo_memories"
-        )
+        # (household_id, camera_id) -> collection
+        self.shards = {}
+        self._shards_lock = threading.Lock()
+        self._query_pool = ThreadPoolExecutor(max_workers=SHARD_QUERY_WORKERS, thread_name_prefix="shard-query")
+
+        # Reopen the original collection (the default household's unnamed camera) and every other shard
+        self.collection = self.shard(DEFAULT_HOUSEHOLD)
+        for collection in self.store_client.list_collections():
+            if isinstance(collection, str):
+                collection = self.store_client.get_collection(collection)
+            metadata = collection.metadata or {}
+            if collection.name.startswith(COLLECTION_NAME + ".") and 'household_id' in metadata:
+                self.shard(metadata['household_id'], metadata.get('camera_id'))
+
+    def shard(self, household_id=None, camera_id=None):
+        """Collection for one household's camera, created on first use"""
+        key = (household_id or DEFAULT_HOUSEHOLD, camera_id or None)
+        with self._shards_lock:
+            collection = self.shards.get(key)
+            if collection is None:
+                name = shard_name(*key)
+                metadata = None
+                if name != COLLECTION_NAME:
+                    metadata = {'household_id': key[0]}
+                    if key[1]:
+                        metadata['camera_id'] = key[1]
+                collection = self.store_client.get_or_create_collection(name=name, metadata=metadata)
+                self._check_embedder(collection)
+                self.shards[key] = collection
+            return collection
+
+    def shards_for(self, household_id=None, camera_ids=None):
+        """Existing shards of a household, optionally only those of the given cameras"""
+        household_id = household_id or DEFAULT_HOUSEHOLD
+        with self._shards_lock:
+            return [
+                collection for (household, camera), collection in self.shards.items()
+                if household == household_id and (camera_ids is None or camera in camera_ids)
+            ]
+
+    def shard_items(self):
+        """[((household_id, camera_id), collection)] of every shard"""
+        with self._shards_lock:
+            return list(self.shards.items())
+
+    def households(self):
+        with self._shards_lock:
+            return sorted({household for household, _ in self.shards})
+
+    def count(self):
+        """Photos across every shard"""
+        with self._shards_lock:
+            collections = list(self.shards.values())
+        return sum(collection.count() for collection in collections)
+
+    def _check_embedder(self, collection):
+        """Record the embedding backend on the collection, or refuse one that differs from what built it"""
+        metadata = dict(collection.metadata or {})
+        if 'embedding_dim' not in metadata:
+            if collection.count() > 0:
+                # Stores created before backends were recorded were all built with OpenAI
+                metadata.update(embedding_backend=f"openai:{OPENAI_EMBEDDING_MODEL}", embedding_dim=OPENAI_EMBEDDING_DIM)
+            else:
+                metadata.update(embedding_backend=self.embedder.name, embedding_dim=self.embedder.dim)
+            collection.modify(metadata=metadata)
+
+        if metadata['embedding_backend'] != self.embedder.name or metadata['embedding_dim'] != self.embedder.dim:
+            raise ValueError(
+                f"Collection {collection.name} was built with {metadata['embedding_backend']} "
+                f"({metadata['embedding_dim']} dims) but the configured embedder is "
+                f"{self.embedder.name} ({self.embedder.dim} dims)"
+            )
 
     def demo_init(self):
         desc1='The image shows a person holding a fried chicken sandwich, likely from Popeyes, in one hand. The sandwich appears golden-brown, with visible crispy breading, suggesting freshly fried chicken. In the background, there is a large white paper bag featuring the Popeyes logo and the text "Popeyes Rewards" in bright orange, accompanied by the tagline "Download. Join. Earn. Enjoy." Additional branding includes small orange graphics, including a squirrel. The setting is a modern kitchen with a granite countertop, a stainless steel sink, and various items such as a jar of PB Fit powdered peanut butter, a bottle of alcohol, and other household objects visible. On the counter near the bag lies an opened sandwich wrapper, also featuring orange branding. A laptop, displaying text or code on its screen, is placed on the counter in the foreground, suggesting the person might be working or programming while eating. The scene feels casual and lived-in, combining work with a meal break.'
@@ -34,67 +215,310 @@ class VectorDB:
         desc5='The image shows a workspace on a granite kitchen countertop. In the foreground, a set of keys with a Wisconsin Badgers lanyard lies next to a black key fob and a brass-colored keychain with text in another language. A large white water bottle is prominently placed in the center, partially obstructing the view of an open laptop on the right. The laptop screen displays a Discord server with multiple channels, and a graphic is visible featuring a stylized leaf or feather logo with text that is not fully readable but seems to include "Tea House." The left edge of the image shows part of another laptop screen with a software window open, possibly for video editing. The environment appears to be casual, likely a kitchen or dining area, given the setting on a stone countertop.'
         image5='keys.jpg'
 
-        self.add_photo(desc1, 20241116_195713, image1)
-        self.add_photo(desc2, 20241116_195714, image2)
-        self.add_photo(desc3, 20241116_195715, image3)
-        self.add_photo(desc4, 20241116_195716, image4)
-        self.add_photo(desc5, 20241116_195717, image5)
-
-        print('Vector DB is loaded...')
-
-    def add_photo(self, description: str, timestamp: str, filename: str):
-        """Add a photo to the database with its analysis"""
-                
-        # Create embeddings for the analysis
-        embedding_response = self.client.embeddings.create(
-            model="text-embedding-3-small",
-            input=description
-        )
-        
+        self.add_photos([
+            {'description': desc1, 'timestamp': 20241116_195713, 'filename': image1},
+            {'description': desc2, 'timestamp': 20241116_195714, 'filename': image2},
+            {'description': desc3, 'timestamp': 20241116_195715, 'filename': image3},
+            {'description': desc4, 'timestamp': 20241116_195716, 'filename': image4},
+            {'description': desc5, 'timestamp': 20241116_195717, 'filename': image5},
+        ])
+
+        log.info('Vector DB is loaded...')
+
+    def add_photo(self, description: str, timestamp: str, filename: str, dhash: int = None,
+                  household_id: str = None, camera_id: str = None):
+        """Add a photo to the database with its analysis, in the shard of its household and camera"""
+        photo = {'description': description, 'timestamp': timestamp, 'filename': filename, 'dhash': dhash,
+                 'household_id': household_id, 'camera_id': camera_id}
+
+        # Includes the wait for the micro-batch to fill when batching is on
+        with STAGE_SECONDS.time(stage='vectordb.add_photo'):
+            if self.batcher:
+                return self.batcher.submit(photo).result()
+
+            return self.add_photos([photo])[0]
+
+    def add_photos(self, batch: List[Dict]) -> List[str]:
+        """
+        Add many photos with one embeddings request per chunk and a single collection upsert
+        batch: list of dicts with description, timestamp, filename and optionally dhash, household_id, camera_id
+        Photos already stored are skipped without being embedded again; the rest are embedded
+        together and upserted once per shard
+        Returns the ids of the photos, in batch order
+        """
+        if not batch:
+            return []
+
+        keys = [(p.get('household_id') or DEFAULT_HOUSEHOLD, p.get('camera_id') or None) for p in batch]
+        ids = [photo_id(p['description'], p['timestamp'], p['filename'], *key) for p, key in zip(batch, keys)]
+
+        # shard key -> {id: photo} of photos not stored yet
+        new = {}
+        for id_, key, photo in zip(ids, keys, batch):
+            new.setdefault(key, {}).setdefault(id_, photo)
+        for key, photos in list(new.items()):
+            existing = set(self.shard(*key).get(ids=list(photos), include=[])['ids'])
+            for id_ in existing:
+                del photos[id_]
+            if not photos:
+                del new[key]
+
+        if not new:
+            return ids
+
+        with STAGE_SECONDS.time(stage='vectordb.embed'):
+            embeddings = self.embed([photo['description'] for photos in new.values() for photo in photos.values()])
+
         # Store in ChromaDB
-        self.collection.add(
-            embeddings=[embedding_response.data[0].embedding],
+        with STAGE_SECONDS.time(stage='vectordb.upsert'):
+            start = 0
+            for key, photos in new.items():
+                self.shard(*key).upsert(
+                    embeddings=embeddings[start:start + len(photos)],
+                    documents=[photo['description'] for photo in photos.values()],
+                    metadatas=[self._metadata(photo) for photo in photos.values()],
+                    ids=list(photos)
+                )
+                start += len(photos)
+
+        self.invalidate()
+
+        return ids
+
+    def add_duplicate(self, source_id: str, timestamp: str, filename: str, dhash: int = None,
+                      household_id: str = None, camera_id: str = None) -> str:
+        """
+        Record a near-duplicate frame by reusing the description and embedding of source_id
+        (any photo of the same household)
+        Makes no model calls; the new row only carries its own timestamp, filename and camera
+        """
+        for collection in self.shards_for(household_id):
+            source = collection.get(ids=[source_id], include=['embeddings', 'documents'])
+            if source['ids']:
+                break
+        else:
+            raise KeyError(f"Unknown photo id {source_id}")
+
+        description = source['documents'][0]
+        id_ = photo_id(description, timestamp, filename, household_id, camera_id)
+        metadata = self._metadata({'timestamp': timestamp, 'filename': filename, 'dhash': dhash,
+                                   'household_id': household_id, 'camera_id': camera_id})
+        metadata['duplicate_of'] = source_id
+
+        self.shard(household_id, camera_id).upsert(
+            embeddings=[source['embeddings'][0]],
             documents=[description],
-            metadatas=[{
-                "timestamp": timestamp,
-                "filename": filename
-            }],
-            ids=[f"photo_{timestamp}"]
+            metadatas=[metadata],
+            ids=[id_]
         )
 
-    def query_photos(self, question: str) -> List[Dict]:
-        """Query photos based on a natural language question"""
+        self.invalidate()
+
+        return id_
+
+    def invalidate(self):
+        """Drop cached results after the collections change (also used by compaction.py)"""
+        with self._version_lock:
+            self.version += 1
+        self.result_cache.clear()
+
+    def photo_hashes(self, household_id=None):
+        """(dhash, id) of every original (non-duplicate) photo with a stored hash in a household"""
+        pairs = []
+        for collection in self.shards_for(household_id):
+            data = collection.get(include=['metadatas'])
+            pairs.extend(
+                (int(metadata['dhash'], 16), id_)
+                for id_, metadata in zip(data['ids'], data['metadatas'])
+                if metadata.get('dhash') and not metadata.get('duplicate_of')
+            )
+        return pairs
+
+    @staticmethod
+    def _metadata(photo: Dict) -> Dict:
+        metadata = {
+            "timestamp": str(photo['timestamp']),
+            "ts": to_epoch(photo['timestamp']),
+            "filename": photo['filename'],
+            # When the row was stored, unlike ts (when the frame was taken); compaction uses it to find
+            # frames that arrived late, e.g. from a camera's spool
+            "added": time.time()
+        }
+        # Stored as hex: a 64-bit hash does not fit Chroma's signed int metadata
+        if photo.get('dhash') is not None:
+            metadata['dhash'] = format(photo['dhash'], '016x')
+        for field in ('household_id', 'camera_id'):
+            if photo.get(field):
+                metadata[field] = photo[field]
+        return metadata
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        return self.embedder.embed(texts)
+
+    def query_photos(self, question: str, since=None, until=None, k: int = 3,
+                     recency_half_life: float = None, household_id: str = None, camera_ids=None) -> List[Dict]:
+        """
+        Query photos based on a natural language question
+        since / until: optional time window (anything to_epoch accepts); the filter runs
+            inside the store so only vectors in the window are searched
+        k: number of results
+        recency_half_life: if set (seconds), rerank candidates so a photo this old counts half
+        household_id / camera_ids: which shards to search (every camera of the default household if not given);
+            shards are searched concurrently and their results merged by distance
+        """
+        household_id = household_id or DEFAULT_HOUSEHOLD
+        camera_ids = tuple(sorted(camera_ids)) if camera_ids is not None else None
+        since = to_epoch(since) if since is not None else None
+        until = to_epoch(until) if until is not None else None
         
-        # Create embedding for the question
-        query_embedding_response = self.client.embeddings.create(
-            model="text-embedding-3-small",
-            input=question
-        )
+        # Create embedding for the question, reusing it for repeat questions
+        key = normalize_query(question)
+        query_embedding = self.query_cache.get(key)
+        if query_embedding is None:
+            with STAGE_SECONDS.time(stage='vectordb.embed_query'):
+                query_embedding = self.embed([question])[0]
+            self.query_cache.set(key, query_embedding)
+
+        # Recency scores depend on the current time, so those results are not cached
+        result_key = (hash(tuple(query_embedding)), self.version, since, until, k, household_id, camera_ids)
+        if not recency_half_life:
+            cached = self.result_cache.get(result_key)
+            if cached is not None:
+                return cached
+
+        conditions = []
+        if since is not None:
+            conditions.append({"ts": {"$gte": since}})
+        if until is not None:
+            conditions.append({"ts": {"$lte": until}})
+        where = None
+        if len(conditions) == 1:
+            where = conditions[0]
+        elif conditions:
+            where = {"$and": conditions}
         
-        # Query ChromaDB
-        results = self.collection.query(
-            query_embeddings=[query_embedding_response.data[0].embedding],
-            n_results=3
-        )
+        n_results = k * RECENCY_CANDIDATES if recency_half_life else k
+
+        def search(collection):
+            return collection.query(
+                query_embeddings=[query_embedding],
+                n_results=n_results,
+                where=where,
+                include=['documents', 'metadatas', 'distances']
+            )
+
+        # Query ChromaDB, one shard per thread
+        shards = self.shards_for(household_id, camera_ids)
+        with STAGE_SECONDS.time(stage='vectordb.search'):
+            if len(shards) == 1:
+                shard_results = [search(shards[0])]
+            else:
+                shard_results = list(self._query_pool.map(search, shards))
         
         # Process results
         processed_results = []
-        for i in range(len(results['documents'][0])):
-            doc = results['documents'][0][i]
-            metadata = results['metadatas'][0][i]
-            timestamp = metadata['timestamp']
-                
-            processed_results.append({
-                'timestamp': timestamp,
-                'filename': metadata['filename'],
-                'description': doc
-            })
+        for results in shard_results:
+            for i in range(len(results['documents'][0])):
+                doc = results['documents'][0][i]
+                metadata = results['metadatas'][0][i]
+                timestamp = metadata['timestamp']
+
+                processed_results.append({
+                    'timestamp': timestamp,
+                    'ts': metadata.get('ts'),
+                    'filename': metadata['filename'],
+                    'camera_id': metadata.get('camera_id'),
+                    'description': doc,
+                    'distance': results['distances'][0][i]
+                })
+
+        # Every shard returns its own top n; keep the global top n
+        processed_results.sort(key=lambda r: r['distance'])
+        del processed_results[n_results:]
+
+        if recency_half_life:
+            now = datetime.now().timestamp()
+            for result in processed_results:
+                # Squared L2 between unit vectors -> cosine similarity
+                similarity = 1 - result['distance'] / 2
+                age = max(0.0, now - (result['ts'] or 0))
+                result['score'] = similarity * 0.5 ** (age / recency_half_life)
+            processed_results.sort(key=lambda r: r['score'], reverse=True)
+            return processed_results[:k]
+
+        self.result_cache.set(result_key, processed_results)
             
         return processed_results
 
-    def save_database(self):
-        """Save the current state of the database"""
-        self.chroma_client.persist()
+    def cache_stats(self) -> Dict:
+        return {
+            'query_embeddings': self.query_cache.stats(),
+            'results': self.result_cache.stats(),
+            'version': self.version
+        }
+
+    def save_database(self, path: str):
+        """
+        Write a snapshot of every shard (embeddings included) to a JSON file
+        A persistent store is already saved on every write; this is for backups and moving data
+        """
+        with self._shards_lock:
+            shards = list(self.shards.items())
+
+        snapshot = {
+            'embedding_backend': self.embedder.name,
+            'embedding_dim': self.embedder.dim,
+            'shards': []
+        }
+        for (household_id, camera_id), collection in shards:
+            data = collection.get(include=['embeddings', 'documents', 'metadatas'])
+            embeddings = data['embeddings'] if data['embeddings'] is not None else []
+            snapshot['shards'].append({
+                'household_id': household_id,
+                'camera_id': camera_id,
+                'ids': data['ids'],
+                'embeddings': [e.tolist() if hasattr(e, 'tolist') else list(e) for e in embeddings],
+                'documents': data['documents'],
+                'metadatas': data['metadatas']
+            })
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+
+        return sum(len(shard['ids']) for shard in snapshot['shards'])
+
+    def load_database(self, path: str):
+        """Restore a snapshot written by save_database, without any embedding calls"""
+        with open(path) as f:
+            snapshot = json.load(f)
+
+        if snapshot.get('embedding_dim', OPENAI_EMBEDDING_DIM) != self.embedder.dim:
+            raise ValueError(
+                f"Snapshot has {snapshot.get('embedding_dim', OPENAI_EMBEDDING_DIM)}-dim embeddings "
+                f"but the configured embedder produces {self.embedder.dim}"
+            )
+
+        # Snapshots from before sharding hold a single collection at the top level
+        shards = snapshot['shards'] if 'shards' in snapshot else [dict(snapshot, household_id=None, camera_id=None)]
+
+        total = 0
+        for shard in shards:
+            collection = self.shard(shard['household_id'], shard['camera_id'])
+            for start in range(0, len(shard['ids']), RESTORE_CHUNK_SIZE):
+                end = start + RESTORE_CHUNK_SIZE
+                collection.upsert(
+                    ids=shard['ids'][start:end],
+                    embeddings=shard['embeddings'][start:end],
+                    documents=shard['documents'][start:end],
+                    metadatas=shard['metadatas'][start:end]
+                )
+            total += len(shard['ids'])
+
+        self.invalidate()
+
+        return total
 
 if __name__ == "__main__":
     app = VectorDB()